@@ -1,2 +1,53 @@
 ITEM_ASSIGNMENT_PROBABILITY = 50  # %
+SELF_ITEMS = ('scoreX2', 'scoreX5', 'bomb', 'get_points_save')  # effects only for the player that activates them
 RELATIVE_POSITION_DEVIATION = 0.25
+REPOSITORY_CHECK_INTERVAL = 1  # seconds between two checks if a json data file changed on disk
+JOURNAL_FSYNC_INTERVAL = 0.05  # seconds a group commit waits for further journal records before fsync
+JOURNAL_FSYNC_BATCH = 64  # fsync immediately once this many journal records are pending
+JOURNAL_COMPACT_THRESHOLD = 500  # journal records after which the journal is folded into the json file
+STORAGE_BACKEND = 'json'  # 'json', 'jsonl' or 'sqlite', see storage.py
+SQLITE_PATH = 'quizgame.db'
+QUESTIONS_JSONL_PATH = 'questions.jsonl'  # questions of the 'jsonl' storage backend
+QUESTION_REPEAT_WINDOW = 50  # a player does not get a question again within this many questions, if the topic allows
+QUESTION_REPEAT_PLAYERS = 10000  # players whose recent questions are remembered, least recently playing ones are dropped
+QUESTION_SELECTION_ATTEMPTS = 8  # draws per question before falling back to a linear pass
+MIN_QUESTION_WEIGHT = 0.1  # lower bound of difficulty factors in the question weight
+MIN_DIFFICULTY = 1  # scale of dynamicDifficulty
+MAX_DIFFICULTY = 5
+DIFFICULTY_PRIOR_ANSWERS = 4  # neutral answers added to every question when its error rate is measured
+DIFFICULTY_INERTIA = 20  # answers needed before the measured difficulty outweighs the current one
+RECALIBRATION_INTERVAL = 600  # seconds between two recalibrations of the dynamic difficulty
+WEBSOCKET_COMPRESSION = True  # offer permessage-deflate to clients
+WEBSOCKET_COMPRESSION_LEVEL = 6
+WEBSOCKET_COMPRESSION_MIN_BYTES = 512  # smaller broadcast frames are sent uncompressed
+SEND_QUEUE_MAX_BYTES = 256 * 1024  # unsent data per connection before a slow client is disconnected
+SEND_QUEUE_MAX_FRAMES = 256
+LOG_LEVEL = 'INFO'  # can be changed at runtime with POST /loglevel
+LOG_FORMAT = '%(asctime)s %(process)d %(levelname)s %(name)s: %(message)s'
+LOG_QUEUE_SIZE = 10000  # records waiting for the writer thread, further records are dropped
+LOG_TRAFFIC_SAMPLE = 1  # keep every n-th record of high volume events
+LOG_TRAFFIC_RATE = 20  # at most this many records of high volume events per second
+JSON_BACKEND = None  # 'orjson', 'ujson' or 'json', None picks the fastest installed one
+PORT = 8888
+WORKERS = 1  # server processes, 0 for one per cpu core
+WORKER_BASE_PORT = 8900  # websocket port of worker i is WORKER_BASE_PORT + i
+LOBBY_SLOTS = 1024  # counters of routed clients shared by the workers, quizzes with the same id modulo this share one
+BACKPLANE = 'inprocess'  # 'inprocess' or 'unix' for several server nodes, see backplane.py
+BACKPLANE_SOCKET = '/tmp/quizgame-backplane.sock'
+BACKPLANE_RECONNECT_DELAY = 1  # seconds
+IO_THREADS = 4  # threads for file and database access of request handlers
+SESSION_SECRET = None  # key of session token signatures, set it when several server nodes share logins
+ADMIN_SECRET = None  # lets other hosts than localhost use /loglevel, /recalibrate and /stats, see README.md
+SESSION_TTL = 24 * 3600  # seconds a session token is valid
+SESSION_CAPACITY = 100000  # sessions kept in memory, the oldest are evicted first
+TIMER_TICK = 0.1  # seconds, resolution of the timer wheel
+TIMER_WHEEL_BITS = 6  # 64 slots per level
+TIMER_WHEEL_LEVELS = 4  # 64 ** 4 ticks, about 19 days with 0.1 s ticks
+QUESTION_DEADLINE_GRACE = 2  # seconds after the response time of a question before unanswered players are resolved
+GAME_ARCHIVE_DELAY = 30  # seconds a finished game still answers late messages before it is removed from memory
+ITEM_HELD_PENALTY = 0.1  # shift of a player's item window towards weaker effects per impact of the items they hold
+ITEM_SPREAD_SCALING = 0.2  # shift of the item windows towards stronger effects when the scores are far apart
+ITEM_LIMITS = {'jackpot': 1}  # players that may hold an effect at the same time
+LEADERBOARD_BUCKET_SIZE = 64  # players per bucket of a leaderboard, see leaderboard.py
+LEADERBOARD_TOP = 10  # players listed in the scoreboard of question and scoreboard messages
+LEADERBOARD_AROUND = 2  # players above and below a player in the answer to a 'rank' message
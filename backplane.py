@@ -0,0 +1,311 @@
+# -*- coding: utf-8 -*-
+"""
+delivery of outgoing messages to players, wherever they are connected.
+the in-process backplane hands messages to the local ConnectionRegistry. with several server nodes, every node
+connects to a broker on a unix domain socket (standing in for a message bus). a node tells the broker which players
+are connected to it, and publishes messages for players that are not connected locally through the broker.
+
+a lobby or game lives on one node, players of other nodes are members of its groups all the same: their lobby and
+game messages are forwarded through the broker to the owning node, which handles them like messages of its own
+players. the first node that forwards a message for the lobby of a quiz owns the lobbies of that quiz,
+a node that starts a game claims the messages of its players for the game.
+
+start the broker before the server nodes and set BACKPLANE = 'unix' in CONSTANTS.py:
+$ python3 backplane.py broker [--path /tmp/quizgame-backplane.sock]
+"""
+import argparse
+import inspect
+import socket
+import struct
+import tornado.ioloop
+import tornado.iostream
+import tornado.netutil
+import tornado.tcpserver
+import codec
+import CONSTANTS
+import log
+from connections import ConnectionRegistry, Frame
+
+logger = log.get_logger('backplane')
+
+_backplane = None
+
+
+class RemoteConnection:
+    """
+    stands in for the websocket of a player of another node, whose message was forwarded to this node
+    """
+    __slots__ = ('pid', 'player')
+
+    def __init__(self, player):
+        self.pid = player.get_id()
+        self.player = player
+
+
+class InProcessBackplane:
+    """
+    all players are connected to this process
+    """
+    handler = None  # handler(player_id, nickname, message dict) of forwarded messages, set by the server
+
+    def broadcast(self, group, message, except_player_id=None, key=None):
+        """
+        sends a message to every member of a group
+        :param group: e.g. lobby_group(quiz_id) or game_group(game_id)
+        :param message: message dict
+        :param except_player_id: member that does not get the message
+        :param key: see connections.Frame
+        """
+        self.publish(ConnectionRegistry.get_members(group, except_player_id), message, key)
+
+    def send(self, player_id, message, key=None):
+        """
+        sends a message to a single player
+        """
+        self.publish([player_id], message, key)
+
+    def publish(self, player_ids, message, key=None):
+        """
+        :param player_ids: recipients
+        :param message: message dict
+        :param key: see connections.Frame
+        """
+        self.deliver(player_ids, Frame(message, key))
+
+    def deliver(self, player_ids, frame):
+        for player_id in player_ids:
+            ConnectionRegistry.queue(player_id, frame)
+
+    def subscribe(self, player_id):
+        """
+        called when a player connected to this process
+        """
+        pass
+
+    def unsubscribe(self, player_id):
+        pass
+
+    def forward(self, key, connection, message, claim=False):
+        """
+        hands a message of a player to the node that owns the lobby or game of key
+        :param key: group of the lobby or game, e.g. lobby_group(quiz_id)
+        :param connection: connection of the sending player
+        :param message: message dict
+        :param claim: this node becomes the owner if key has none yet, e.g. for the first lobby of a quiz
+        :return: True if the message was forwarded, False if it is to be handled here
+        """
+        return False
+
+    def claim(self, key, player_ids):
+        """
+        messages of these players for key (the group of a game) are forwarded to this node
+        """
+        pass
+
+    def release(self, key, player_ids):
+        pass
+
+
+class UnixSocketBackplane(InProcessBackplane):
+    """
+    node of a multi-node deployment, messages for players that are connected to another node go through the broker
+    """
+    def __init__(self, path):
+        """
+        :param path: unix socket of the broker
+        """
+        self.path = path
+        self.stream = None
+        self.claims = {}  # {key: player ids} claimed by this node, claimed again after a reconnect
+        self.connect()
+
+    def publish(self, player_ids, message, key=None):
+        local = []
+        remote = []
+        for player_id in player_ids:
+            (local if self.is_local(player_id) else remote).append(player_id)
+        if local:
+            self.deliver(local, Frame(message, key))
+        if remote:
+            self.write({'op': 'pub', 'players': remote, 'message': message, 'key': key})
+
+    def is_local(self, player_id):
+        return player_id in ConnectionRegistry.players
+
+    def subscribe(self, player_id):
+        self.write({'op': 'sub', 'players': [player_id]})
+
+    def unsubscribe(self, player_id):
+        self.write({'op': 'unsub', 'players': [player_id]})
+
+    def forward(self, key, connection, message, claim=False):
+        if isinstance(connection, RemoteConnection) or self.stream is None or self.stream.closed():
+            return False  # forwarded to this node already, or no other node can be reached
+        player = connection.player
+        self.write({'op': 'route', 'key': key, 'claim': claim, 'player': player.get_id(),
+                    'nickname': player.get_nickname(), 'message': message})
+        return True
+
+    def claim(self, key, player_ids):
+        self.claims[key] = player_ids
+        self.write({'op': 'claim', 'key': key, 'players': player_ids})
+
+    def release(self, key, player_ids):
+        self.claims.pop(key, None)
+        self.write({'op': 'release', 'key': key, 'players': player_ids})
+
+    def write(self, entry):
+        if self.stream is None or self.stream.closed():
+            return  # the local players subscribe again after the reconnect
+        self.stream.write(_pack(entry))
+
+    def connect(self):
+        self.stream = tornado.iostream.IOStream(socket.socket(socket.AF_UNIX, socket.SOCK_STREAM))
+        connected = self.stream.connect(self.path)
+        self.write({'op': 'sub', 'players': list(ConnectionRegistry.players)})  # buffered until connected
+        for key, player_ids in self.claims.items():
+            self.write({'op': 'claim', 'key': key, 'players': player_ids})
+        tornado.ioloop.IOLoop.current().add_callback(self._read_loop, self.stream, connected)
+
+    async def _read_loop(self, stream, connected):
+        try:
+            await connected
+            while True:
+                entry = await _read(stream)
+                if entry['op'] == 'handle':
+                    await self.handle(entry)
+                else:
+                    self.deliver(entry['players'], Frame(entry['message'], entry['key']))
+        except tornado.iostream.StreamClosedError:
+            logger.warning('lost connection to the backplane broker at %s, reconnecting', self.path)
+            tornado.ioloop.IOLoop.current().call_later(CONSTANTS.BACKPLANE_RECONNECT_DELAY, self.connect)
+
+    async def handle(self, entry):
+        """
+        handles a message that a player of another node sent to a lobby or game of this node. like the messages of
+        a websocket, it is handled completely before the next forwarded message
+        """
+        if self.handler is None:
+            return
+        try:
+            result = self.handler(entry['player'], entry['nickname'], entry['message'])
+            if inspect.isawaitable(result):
+                await result
+        except Exception:
+            logger.exception('forwarded message of player %s failed', entry['player'])
+
+
+class BackplaneBroker(tornado.tcpserver.TCPServer):
+    """
+    forwards published messages to the nodes the recipients are connected to, and messages of players to the nodes
+    that own their lobby or game
+    """
+    def __init__(self):
+        super().__init__()
+        self.nodes = {}  # {player_id: stream of the node the player is connected to}
+        self.owners = {}  # {lobby group: stream of the node that owns the lobbies of the quiz}
+        self.claims = {}  # {(game group, player_id): stream of the node that hosts the game}
+
+    async def handle_stream(self, stream, address):
+        try:
+            while True:
+                entry = await _read(stream)
+                if entry['op'] == 'sub':
+                    for player_id in entry['players']:
+                        self.nodes[player_id] = stream
+                elif entry['op'] == 'unsub':
+                    for player_id in entry['players']:
+                        if self.nodes.get(player_id) is stream:
+                            del self.nodes[player_id]
+                elif entry['op'] == 'pub':
+                    self.forward(entry)
+                elif entry['op'] == 'route':
+                    self.route(stream, entry)
+                elif entry['op'] == 'claim':
+                    for player_id in entry['players']:
+                        self.claims[(tuple(entry['key']), player_id)] = stream
+                elif entry['op'] == 'release':
+                    key = tuple(entry['key'])
+                    for player_id in entry['players']:
+                        if self.claims.get((key, player_id)) is stream:
+                            del self.claims[(key, player_id)]
+        except tornado.iostream.StreamClosedError:
+            for entries in (self.nodes, self.owners, self.claims):
+                for key in [key for key, node in entries.items() if node is stream]:
+                    del entries[key]
+
+    def route(self, stream, entry):
+        """
+        hands the message of a player to the node that owns its lobby or game
+        """
+        key = tuple(entry['key'])  # groups are tuples, the codec turns them into lists
+        owner = self.claims.get((key, entry['player'])) or self.owners.get(key)
+        if owner is None and entry['claim']:
+            owner = self.owners[key] = stream
+        if owner is None or owner.closed():
+            logger.warning('dropped message of player %s for %s, no node owns it', entry['player'], key)
+            return
+        owner.write(_pack({'op': 'handle', 'player': entry['player'], 'nickname': entry['nickname'],
+                           'message': entry['message']}))
+
+    def forward(self, entry):
+        recipients = {}  # {stream: player ids}
+        for player_id in entry['players']:
+            node = self.nodes.get(player_id)
+            if node is not None:
+                recipients.setdefault(node, []).append(player_id)
+        for node, player_ids in recipients.items():
+            if not node.closed():
+                node.write(_pack({'op': 'deliver', 'players': player_ids, 'message': entry['message'],
+                                  'key': entry['key']}))
+
+
+def _pack(entry):
+    data = codec.dumps(entry)
+    return struct.pack('>I', len(data)) + data
+
+
+async def _read(stream):
+    length, = struct.unpack('>I', await stream.read_bytes(4))
+    return codec.loads(await stream.read_bytes(length))
+
+
+def get_backplane():
+    global _backplane
+    if _backplane is None:
+        _backplane = create_backplane()
+    return _backplane
+
+
+def set_backplane(backplane):
+    global _backplane
+    _backplane = backplane
+
+
+def create_backplane(name=None):
+    """
+    :param name: 'inprocess' or 'unix', defaults to BACKPLANE
+    """
+    name = name or CONSTANTS.BACKPLANE
+    if name == 'unix':
+        return UnixSocketBackplane(CONSTANTS.BACKPLANE_SOCKET)
+    if name == 'inprocess':
+        return InProcessBackplane()
+    raise ValueError('unknown backplane: ' + name)
+
+
+def run_broker(path):
+    broker = BackplaneBroker()
+    broker.add_socket(tornado.netutil.bind_unix_socket(path))
+    logger.info('backplane broker listening on %s', path)
+    tornado.ioloop.IOLoop.current().start()
+
+
+if __name__ == '__main__':
+    log.setup()
+    parser = argparse.ArgumentParser(description='backplane broker of multi-node deployments')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    broker_parser = subparsers.add_parser('broker', help='run the broker')
+    broker_parser.add_argument('--path', default=CONSTANTS.BACKPLANE_SOCKET)
+    args = parser.parse_args()
+    run_broker(args.path)
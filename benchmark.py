@@ -0,0 +1,513 @@
+# -*- coding: utf-8 -*-
+"""
+benchmarks for the game server, run from the repository root:
+$ python3 benchmark.py <name>
+"""
+import argparse
+import gc
+import json
+import multiprocessing
+import os
+import shutil
+import signal
+import socket
+import subprocess
+import sys
+import tempfile
+import time
+import tracemalloc
+import backplane
+import codec
+import CONSTANTS
+import log
+from connections import ConnectionRegistry
+from router import MessageRouter, Schema, boolean, integer, number, string
+from items import ItemDistributor
+from leaderboard import Leaderboard
+from selection import QuestionSelector
+from timerwheel import TimerWheel, timers
+from logic import *
+from model import *
+
+
+def bench_memory(games=1000, players_per_game=4):
+    """
+    bytes allocated per active game, every game gets its own quiz like a game opened through the LobbyPool
+    """
+    players = [get_player(player_id) for player_id in range(1, players_per_game + 1)]
+    get_quiz(1).get_questions()  # warm up repositories and pools, they are shared by all games
+    gc.collect()
+    tracemalloc.start()
+    before = tracemalloc.take_snapshot()
+    active = []
+    for game_id in range(games):
+        quiz = get_quiz(1)
+        protocol = Protocol(quiz.get_id())
+        for player in players:
+            protocol.add_player(player.get_id())
+        active.append(Game(game_id, quiz, players, protocol))
+    gc.collect()
+    after = tracemalloc.take_snapshot()
+    tracemalloc.stop()
+    allocated = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+    print('memory: ' + str(games) + ' games, ' + str(allocated // games) + ' bytes per active game')
+
+
+def bench_items(calls=20000, sizes=(4, 8, 100, 1000)):
+    """
+    time to choose the effects attached to an answer, for scoreboards of growing size with held items
+    """
+    import random
+    distributor = ItemDistributor(seed=1)
+    for size in sizes:
+        leaderboard = Leaderboard({player_id: random.randint(0, 3000) for player_id in range(size)})
+        player_items = {'jackpot': {0: 1}, 'bomb': {player_id: 1 for player_id in range(0, size, 3)}}
+        repeat = max(20, calls // size)
+        start = time.perf_counter()
+        for _ in range(repeat):
+            distributor.distribute(leaderboard, player_items)
+        elapsed = time.perf_counter() - start
+        print('items: ' + str(size) + ' players, ' + str(round(elapsed / repeat * 1e6, 2)) + ' us per distribution')
+
+
+def bench_leaderboard(players=10000, calls=100000):
+    """
+    score updates and rank queries on the leaderboard of a game with many players,
+    compared with sorting a scoreboard dict for a rank
+    """
+    import random
+    scoreboard = {player_id: random.randint(0, 10000) for player_id in range(players)}
+    leaderboard = Leaderboard(scoreboard)
+    player_ids = [random.randrange(players) for _ in range(calls)]
+    for name, call in (('update', lambda player_id: leaderboard.add(player_id, 100)),
+                       ('rank', leaderboard.rank),
+                       ('top 10', lambda player_id: leaderboard.top(10)),
+                       ('around 2', lambda player_id: leaderboard.around(player_id, 2))):
+        start = time.perf_counter()
+        for player_id in player_ids:
+            call(player_id)
+        elapsed = time.perf_counter() - start
+        print('leaderboard: ' + str(players) + ' players, ' + name + ' ' + str(round(elapsed / calls * 1e6, 2)) + ' us')
+    start = time.perf_counter()
+    for player_id in player_ids[:100]:
+        sorted(scoreboard, key=scoreboard.get, reverse=True).index(player_id)
+    elapsed = time.perf_counter() - start
+    print('leaderboard: ' + str(players) + ' players, rank by sorting the dict ' + str(round(elapsed / 100 * 1e6, 2)) + ' us')
+
+
+def bench_lifecycle(games=2000, players_per_game=4):
+    """
+    games played from start to end and archived: throughput, games left in memory and the memory they retain.
+    runs in a temporary copy of the data files, the results are appended to its results.jsonl
+    """
+    import asyncio
+    import tornado.ioloop
+    from storage import JsonBackend, set_storage
+    cwd = os.getcwd()
+    directory = tempfile.mkdtemp()
+    for name in ('players.json', 'questions.json', 'quizzes.json'):
+        shutil.copy(name, directory)
+    os.chdir(directory)  # the protocol.json of finished games is written here as well
+    storage = JsonBackend()
+    set_storage(storage)
+    players = [get_player(player_id) for player_id in range(1, players_per_game + 1)]
+    quiz = get_quiz(1)
+
+    async def run():
+        gc.collect()
+        tracemalloc.start()
+        before = tracemalloc.take_snapshot()
+        start = time.perf_counter()
+        for _ in range(games):
+            protocol = Protocol(quiz.get_id())
+            for player in players:
+                protocol.add_player(player.get_id())
+            GamePool.get_game(GamePool.start_game(quiz, players, protocol)).end()
+        finished = len(GamePool.games)
+        timers.advance(time.monotonic() + CONSTANTS.GAME_ARCHIVE_DELAY + 1)
+        while len(storage.all_records('results')) < games:
+            await asyncio.sleep(0.01)
+        await asyncio.gather(*(run_io(int) for _ in range(CONSTANTS.IO_THREADS)))  # protocol writes
+        elapsed = time.perf_counter() - start
+        gc.collect()
+        after = tracemalloc.take_snapshot()
+        tracemalloc.stop()
+        retained = sum(stat.size_diff for stat in after.compare_to(before, 'filename'))
+        print('lifecycle: ' + str(games) + ' games, ' + str(round(games / elapsed)) + ' games per second, ' +
+              str(finished) + ' finished and ' + str(len(GamePool.games)) + ' left after archiving, ' +
+              str(retained // games) + ' bytes retained per game')
+
+    try:
+        tornado.ioloop.IOLoop.current().run_sync(run)
+    finally:
+        os.chdir(cwd)
+        shutil.rmtree(directory)
+
+
+def bench_selection(calls=20000, k=6, sizes=(100, 10000, 200000)):
+    """
+    time to draw the questions of one game, for topics of growing size
+    """
+    for size in sizes:
+        question_selector = QuestionSelector(seed=1)
+        records = [{'id': question_id, 'staticDifficulty': question_id % 5 + 1, 'dynamicDifficulty': 1}
+                   for question_id in range(1, size + 1)]
+        question_selector.load_topic('topic', records)
+        question_selector.get_table = lambda topic: question_selector.tables[topic]
+        start = time.perf_counter()
+        for call in range(calls):
+            question_selector.select('topic', k, (call % 64,))
+        elapsed = time.perf_counter() - start
+        print('selection: topic of ' + str(size) + ' questions, ' + str(round(elapsed / calls * 1e6, 2)) + ' us per game')
+
+
+def bench_logging(calls=200000):
+    """
+    event loop time per log call: a disabled level, a rate limited traffic record and a plain record,
+    the records are written to /dev/null by the background writer
+    """
+    log.setup('INFO', open(os.devnull, 'w'))
+    logger = log.get_logger('benchmark')
+    traffic_logger = log.get_traffic_logger('benchmark')
+    message = '{"type": "answered_question", "game_id": 0, "q_id": 3}'
+    for name, call, level in (('disabled', logger.debug, 'INFO'),
+                              ('traffic', traffic_logger.debug, 'DEBUG'),
+                              ('plain', logger.info, 'INFO')):
+        log.set_level(level)
+        start = time.perf_counter()
+        for _ in range(calls):
+            call('incoming message: %s', message)
+        elapsed = time.perf_counter() - start
+        print('logging: ' + name + ', ' + str(round(elapsed / calls * 1e6, 2)) + ' us per call')
+    print('logging: ' + str(log.get_dropped()) + ' records dropped by the full queue')
+
+
+def bench_dispatch(calls=100000):
+    """
+    per message overhead of the router (parsing, validation, game lookup and dispatch) with a handler that does nothing
+    """
+    class Connection:
+        pid = 1
+        player = None
+    games = {0: object()}
+    router = MessageRouter(lambda game_id, player_id: games.get(game_id))
+    log.set_level('ERROR', 'router.traffic')  # keep logging of the rejections out of the measurement
+    played_question = Schema('PlayedQuestion', {'score': number,
+                                                'is_correct': boolean,
+                                                'is_jackpot': (boolean, False),
+                                                'acquired_item': (string, None)})
+    router.route('answered_question', game_id=integer, q_id=integer, played_question=played_question)(
+        lambda context, message: None)
+    valid = json.dumps({'type': 'answered_question', 'game_id': 0, 'q_id': 3, 'a_id': 1,
+                        'played_question': {'speed': 4, 'is_jackpot': False, 'is_correct': True, 'score': 350}})
+    invalid = json.dumps({'type': 'answered_question', 'game_id': 0, 'q_id': 3})
+    for name, message in (('valid', valid), ('malformed', invalid)):
+        start = time.perf_counter()
+        for _ in range(calls):
+            router.dispatch(Connection, message)
+        elapsed = time.perf_counter() - start
+        print('dispatch: ' + name + ' message, ' + str(round(elapsed / calls * 1e6, 2)) + ' us per message')
+
+
+def bench_codec(calls=20000, players=8):
+    """
+    encoding and decoding time of the installed json backends, for the messages the server sends most
+    """
+    question = get_quiz(1).get_questions()[0].to_json()
+    scoreboard = {player_id: player_id * 150 for player_id in range(1, players + 1)}
+    messages = {'question': {'type': 'question',
+                             'question': question,
+                             'jackpot': {'amount': 1400, 'is_active': False},
+                             'scoreboard_delta': {'seq': 3, 'base': 2, 'scores': scoreboard}},
+                'lobby': {'type': 'lobby',
+                          'lobby': list(scoreboard),
+                          'nicks': ['player' + str(player_id) for player_id in scoreboard]},
+                'scoreboard': {'type': 'scoreboard_sync', 'scoreboard': scoreboard, 'seq': 3}}
+    for name, (dumps, loads) in codec.get_backends().items():
+        for message_type, message in messages.items():
+            start = time.perf_counter()
+            for _ in range(calls):
+                data = dumps(message)
+            encoded = time.perf_counter() - start
+            start = time.perf_counter()
+            for _ in range(calls):
+                loads(data)
+            decoded = time.perf_counter() - start
+            print('codec: ' + name + ', ' + message_type + ' (' + str(len(data)) + ' bytes), ' +
+                  str(round(encoded / calls * 1e6, 2)) + ' us to encode, ' +
+                  str(round(decoded / calls * 1e6, 2)) + ' us to decode')
+
+
+def _play(port, player_ids, concurrency):
+    """
+    client process of bench_workers, plays one game per player id with up to concurrency players at a time
+    :return: (completed players, time of the last completion)
+    """
+    import asyncio
+    import tornado.httpclient
+    import tornado.ioloop
+    import tornado.websocket
+
+    async def player(player_id, http):
+        response = await http.fetch('http://localhost:%d/login' % port, method='POST',
+                                    body=codec.dumps({'username': 'bench' + str(player_id)}))
+        token = codec.loads(response.body)['token']
+        response = await http.fetch('http://localhost:%d/route?q_id=1' % port)
+        ws_port = codec.loads(response.body)['port']
+        connection = await tornado.websocket.websocket_connect('ws://localhost:%d/websocket?token=%s' % (ws_port, token))
+        connection.write_message(codec.dumps_text({'type': 'join_lobby', 'q_id': 1}))
+        game_id = None
+        while True:
+            message = await connection.read_message()
+            if message is None:
+                return False
+            message = codec.loads(message)
+            if message['type'] == 'game_start':
+                game_id = message['game_id']
+            elif message['type'] == 'question':
+                connection.write_message(codec.dumps_text({
+                    'type': 'answered_question', 'game_id': game_id, 'q_id': message['question']['id'],
+                    'played_question': {'is_correct': True, 'is_jackpot': False, 'score': 100}}))
+            elif message['type'] == 'scoreboard':
+                connection.close()
+                return True
+
+    async def run():
+        http = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+        semaphore = asyncio.Semaphore(concurrency)
+        completed = [0, 0.0]
+
+        async def limited(player_id):
+            async with semaphore:
+                if await player(player_id, http):
+                    completed[0] += 1
+                    completed[1] = time.time()
+        await asyncio.gather(*(limited(player_id) for player_id in player_ids))
+        return tuple(completed)
+
+    return tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def bench_workers(players=2000, concurrency=64, worker_counts=None, port=18900):
+    """
+    finished games per second of the server with one and with several worker processes.
+    the server runs on a copy of the data files with generated players, the players are simulated
+    by as many client processes as there are cpu cores
+    """
+    cores = multiprocessing.cpu_count()
+    worker_counts = worker_counts or (1, max(cores, 2))
+    clients = max(cores, 2)
+    for workers in worker_counts:
+        directory = tempfile.mkdtemp()
+        for name in ('questions.json', 'quizzes.json'):
+            shutil.copy(name, directory)
+        with open(os.path.join(directory, 'players.json'), 'wb') as f:
+            codec.dump({'highest_id': players,
+                        'players': [{'id': player_id, 'nickname': 'bench' + str(player_id), 'password': '', 'mail': ''}
+                                    for player_id in range(1, players + 1)]}, f)
+        command = [sys.executable, os.path.abspath('main.py'), '--port', str(port), '--workers', str(workers)]
+        if workers > 1:  # several workers only run on sqlite
+            subprocess.run([sys.executable, os.path.abspath('storage.py'), 'migrate'], cwd=directory, check=True,
+                           stdout=subprocess.DEVNULL)
+            command += ['--storage', 'sqlite']
+        server = subprocess.Popen(command, cwd=directory, stderr=subprocess.DEVNULL, start_new_session=True)
+        try:
+            _wait_for_port(port)
+            _wait_for_port(port if workers == 1 else CONSTANTS.WORKER_BASE_PORT + workers - 1)
+            start = time.time()
+            with multiprocessing.Pool(clients) as pool:
+                results = pool.starmap(_play, [(port, range(client + 1, players + 1, clients), concurrency // clients)
+                                               for client in range(clients)])
+            completed = sum(result[0] for result in results)
+            elapsed = max(result[1] for result in results) - start
+            print('workers: ' + str(workers) + ' worker(s), ' + str(completed // 2) + ' games, ' +
+                  str(round(completed / 2 / elapsed, 1)) + ' games per second')
+        finally:
+            os.killpg(server.pid, signal.SIGTERM)  # the forked workers as well
+            server.wait()
+            shutil.rmtree(directory)
+
+
+def _wait_for_port(port, timeout=10):
+    deadline = time.time() + timeout
+    while True:
+        try:
+            socket.create_connection(('localhost', port), 0.5).close()
+            return
+        except OSError:
+            if time.time() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def bench_backplane(messages=2000):
+    """
+    latency from publishing a message to handing it to the recipient's connection, in-process and through
+    the unix socket broker. both nodes of the broker measurement run in this process
+    """
+    import asyncio
+    import tornado.ioloop
+
+    class Connection:
+        written = None
+
+        def encode_frame(self, frame):
+            return frame.get_bytes()
+
+        def write_bytes(self, data):
+            self.written.set()
+            return None
+
+    class RemoteNode(backplane.UnixSocketBackplane):
+        def is_local(self, player_id):
+            return False
+
+    async def measure(name, publisher):
+        connection = Connection()
+        ConnectionRegistry.register(1, connection)
+        latencies = []
+        message = {'type': 'user_message', 'message': 'hello'}
+        for _ in range(messages):
+            connection.written = asyncio.Event()
+            start = time.perf_counter()
+            publisher.send(1, message)
+            await connection.written.wait()
+            latencies.append(time.perf_counter() - start)
+        ConnectionRegistry.unregister(1, connection)
+        latencies.sort()
+        print('backplane: ' + name + ', ' + str(round(sum(latencies) / messages * 1e6, 1)) + ' us mean, ' +
+              str(round(latencies[int(messages * 0.99)] * 1e6, 1)) + ' us p99')
+
+    async def run():
+        await measure('in-process', backplane.InProcessBackplane())
+        directory = tempfile.mkdtemp()
+        path = os.path.join(directory, 'backplane.sock')
+        broker = subprocess.Popen([sys.executable, os.path.abspath('backplane.py'), 'broker', '--path', path],
+                                  stderr=subprocess.DEVNULL)
+        try:
+            while not os.path.exists(path):
+                await asyncio.sleep(0.05)
+            receiver = backplane.UnixSocketBackplane(path)
+            receiver.subscribe(1)
+            publisher = RemoteNode(path)
+            await asyncio.sleep(0.2)  # until the subscription reached the broker
+            await measure('unix socket broker', publisher)
+        finally:
+            broker.terminate()
+            broker.wait()
+            shutil.rmtree(directory)
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def _login_storm(port, logins, concurrency):
+    """
+    client process of bench_loop_lag
+    """
+    import asyncio
+    import tornado.httpclient
+    import tornado.ioloop
+
+    async def run():
+        http = tornado.httpclient.AsyncHTTPClient(max_clients=concurrency)
+        body = codec.dumps_text({'username': 'test1'})
+        await asyncio.gather(*(http.fetch('http://localhost:%d/login' % port, method='POST', body=body)
+                               for _ in range(logins)))
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def bench_loop_lag(logins=3000, concurrency=100, port=18950, interval=0.001):
+    """
+    event loop lag of the server during a login storm, measured as the delay of a 1 ms timer
+    """
+    import asyncio
+    import tornado.ioloop
+    import main
+
+    async def run():
+        main.make_app().listen(port)
+        # spawned, a forked child would inherit the running event loop
+        storm = multiprocessing.get_context('spawn').Process(target=_login_storm, args=(port, logins, concurrency))
+        storm.start()
+        lags = []
+        while storm.is_alive():
+            start = time.perf_counter()
+            await asyncio.sleep(interval)
+            lags.append(time.perf_counter() - start - interval)
+        storm.join()
+        lags.sort()
+        print('loop lag: ' + str(logins) + ' logins, ' + str(round(lags[len(lags) // 2] * 1e3, 2)) + ' ms median, ' +
+              str(round(lags[int(len(lags) * 0.99)] * 1e3, 2)) + ' ms p99, ' + str(round(lags[-1] * 1e3, 2)) + ' ms max')
+
+    tornado.ioloop.IOLoop.current().run_sync(run)
+
+
+def bench_timers(games=50000, seconds=120):
+    """
+    question deadlines of many concurrent games on the timer wheel, driven by a simulated clock: every game schedules
+    a deadline, most games answer before it and reschedule. compared with a call_later per deadline on the IOLoop
+    """
+    import random
+    import tornado.ioloop
+    now = [0.0]
+    wheel = TimerWheel(clock=lambda: now[0])
+    expired = [0]
+
+    def expire():
+        expired[0] += 1
+    start = time.perf_counter()
+    deadlines = [wheel.schedule(random.uniform(10, 60), expire) for _ in range(games)]
+    scheduled = time.perf_counter() - start
+    ticks = []
+    rescheduled = 0
+    while now[0] < seconds:
+        now[0] += wheel.tick
+        for _ in range(games // 200):  # games whose players all answered, the next question starts
+            game = random.randrange(games)
+            deadlines[game].cancel()
+            deadlines[game] = wheel.schedule(random.uniform(10, 60), expire)
+            rescheduled += 1
+        start = time.perf_counter()
+        wheel.advance()
+        ticks.append(time.perf_counter() - start)
+    ticks.sort()
+    print('timers: ' + str(games) + ' games, ' + str(round(scheduled / games * 1e6, 2)) + ' us per schedule, ' +
+          str(rescheduled) + ' reschedules, ' + str(expired[0]) + ' expired, tick ' +
+          str(round(ticks[len(ticks) // 2] * 1e3, 3)) + ' ms median, ' + str(round(ticks[-1] * 1e3, 3)) + ' ms max')
+
+    io_loop = tornado.ioloop.IOLoop.current()
+    start = time.perf_counter()
+    handles = [io_loop.call_later(random.uniform(10, 60), expire) for _ in range(games)]
+    scheduled = time.perf_counter() - start
+    start = time.perf_counter()
+    for handle in handles:
+        io_loop.remove_timeout(handle)
+    removed = time.perf_counter() - start
+    print('timers: call_later, ' + str(round(scheduled / games * 1e6, 2)) + ' us per schedule, ' +
+          str(round(removed / games * 1e6, 2)) + ' us per cancel')
+
+
+BENCHMARKS = {'backplane': bench_backplane,
+              'codec': bench_codec,
+              'dispatch': bench_dispatch,
+              'items': bench_items,
+              'leaderboard': bench_leaderboard,
+              'lifecycle': bench_lifecycle,
+              'logging': bench_logging,
+              'loop_lag': bench_loop_lag,
+              'memory': bench_memory,
+              'selection': bench_selection,
+              'timers': bench_timers,
+              'workers': bench_workers}
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='game server benchmarks')
+    parser.add_argument('names', nargs='*', help='benchmarks to run, default all: ' + ', '.join(sorted(BENCHMARKS)))
+    args = parser.parse_args()
+    for name in args.names:
+        if name not in BENCHMARKS:
+            parser.error('unknown benchmark: ' + name)
+    for name in args.names or sorted(BENCHMARKS):
+        BENCHMARKS[name]()
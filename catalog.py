@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+import codec
+import hashlib
+import threading
+from model import *
+
+
+class QuizCatalog:
+    """
+    cache of the encoded responses of the /quizzes endpoint
+    every entry is a tuple (body bytes, etag). the cache is dropped when the stored quizzes or questions change.
+    it is used from the io threads: a version change swaps in a new entries dict, every call works on the dict of
+    the versions it checked
+    """
+    cache = (None, {})  # (versions, {None: entry of the quiz list, quiz_id: entry of a single quiz})
+    lock = threading.Lock()
+
+    @staticmethod
+    def get_list():
+        """
+        :return: (body, etag) of the list of all quizzes
+        """
+        entries = QuizCatalog._get_entries()
+        entry = entries.get(None)
+        if entry is None:
+            quizzes = get_storage().all_records('quizzes')
+            # quiz records are converted without hydrating their questions, to_json only needs the scalar fields
+            entry = entries[None] = QuizCatalog._encode([Quiz.from_json(quiz).to_json() for quiz in quizzes])
+        return entry
+
+    @staticmethod
+    def get_quiz(quiz_id):
+        """
+        :return: (body, etag) of a single quiz or None if there is no such quiz
+        """
+        entries = QuizCatalog._get_entries()
+        quiz_id = int(quiz_id)
+        entry = entries.get(quiz_id)
+        if entry is None:
+            quiz = get_storage().get_record('quizzes', quiz_id)
+            if quiz is None:
+                return None
+            entry = entries[quiz_id] = QuizCatalog._encode(Quiz.from_json(quiz).to_json())
+        return entry
+
+    @staticmethod
+    def _get_entries():
+        """
+        :return: entries of the current versions of the quizzes and questions
+        """
+        versions = (get_storage().get_version('quizzes'), get_storage().get_version('questions'))
+        with QuizCatalog.lock:
+            if versions != QuizCatalog.cache[0]:
+                QuizCatalog.cache = (versions, {})
+            return QuizCatalog.cache[1]
+
+    @staticmethod
+    def _encode(data):
+        body = codec.dumps(data)
+        return body, '"' + hashlib.sha1(body).hexdigest() + '"'
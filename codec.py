@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+json encoding of messages, responses and data files. uses orjson or ujson if one of them is installed,
+the json module otherwise. JSON_BACKEND in CONSTANTS.py picks a backend explicitly.
+all backends encode to utf-8 bytes, accept bytes and str when decoding and raise a ValueError for invalid json.
+dict keys that are not strings (e.g. player ids in a scoreboard) are written as strings
+"""
+import json
+import CONSTANTS
+
+
+def _json_backend():
+    encoder = json.JSONEncoder(ensure_ascii=False, separators=(',', ':'))
+    return lambda obj: encoder.encode(obj).encode('utf-8'), json.loads
+
+
+def _orjson_backend():
+    import orjson
+    options = orjson.OPT_NON_STR_KEYS
+    return lambda obj: orjson.dumps(obj, option=options), orjson.loads
+
+
+def _ujson_backend():
+    import ujson
+    return lambda obj: ujson.dumps(obj, ensure_ascii=False).encode('utf-8'), ujson.loads
+
+
+FACTORIES = {'orjson': _orjson_backend,
+             'ujson': _ujson_backend,
+             'json': _json_backend}
+PREFERENCE = ('orjson', 'ujson', 'json')
+
+
+def get_backends():
+    """
+    :return: {name: (dumps, loads)} of the installed backends
+    """
+    backends = {}
+    for name in PREFERENCE:
+        try:
+            backends[name] = FACTORIES[name]()
+        except ImportError:
+            pass
+    return backends
+
+
+def get_backend(name=None):
+    """
+    :param name: backend name, the fastest installed backend if None
+    :return: (name, dumps, loads)
+    """
+    if name:
+        return (name,) + FACTORIES[name]()
+    for candidate in PREFERENCE:
+        try:
+            return (candidate,) + FACTORIES[candidate]()
+        except ImportError:
+            pass
+
+
+backend, dumps, loads = get_backend(CONSTANTS.JSON_BACKEND)
+
+
+def dumps_text(obj):
+    """
+    json as str, e.g. for text columns
+    """
+    return dumps(obj).decode('utf-8')
+
+
+def load(f):
+    """
+    :param f: file opened in text or binary mode
+    """
+    return loads(f.read())
+
+
+def dump(obj, f):
+    """
+    :param f: file opened in binary mode
+    """
+    f.write(dumps(obj))
@@ -0,0 +1,252 @@
+# -*- coding: utf-8 -*-
+import struct
+import zlib
+from collections import deque
+import tornado.ioloop
+import CONSTANTS
+import wire
+from log import get_logger
+
+logger = get_logger('connections')
+
+
+class Frame:
+    """
+    a websocket frame of one outgoing message, encoded once per wire encoding and written to every recipient.
+    the deflated variant (permessage-deflate, RSV1 set) is only built if a recipient can take it
+    """
+    __slots__ = ('message', 'key', '_frames')
+
+    def __init__(self, message, key=None):
+        """
+        :param message: message dict
+        :param key: frames of state that a newer frame with the same key replaces, e.g. the lobby state.
+                    a queued frame that was not written yet is dropped when such a newer frame is queued
+        """
+        self.message = message
+        self.key = key
+        self._frames = {}  # {(encoding, window bits): frame bytes}
+
+    def get_bytes(self, encoding=wire.JSON, window_bits=None):
+        """
+        :param encoding: wire encoding of the recipient, see wire.py
+        :param window_bits: negotiated server_max_window_bits if the recipient takes permessage-deflate without
+                            server context takeover, None for plain frames
+        """
+        key = (encoding, window_bits)
+        frame = self._frames.get(key)
+        if frame is None:
+            payload, opcode = wire.encode(self.message, encoding)
+            if window_bits and CONSTANTS.WEBSOCKET_COMPRESSION and \
+                    len(payload) >= CONSTANTS.WEBSOCKET_COMPRESSION_MIN_BYTES:
+                compressor = zlib.compressobj(CONSTANTS.WEBSOCKET_COMPRESSION_LEVEL, zlib.DEFLATED, -window_bits)
+                data = compressor.compress(payload) + compressor.flush(zlib.Z_SYNC_FLUSH)
+                frame = build_frame(data[:-4], opcode, compressed=True)  # without the 00 00 ff ff tail
+            else:
+                frame = build_frame(payload, opcode)
+            self._frames[key] = frame
+        return frame
+
+
+def build_frame(payload, opcode=0x1, compressed=False):
+    """
+    unmasked server to client websocket frame (RFC 6455) with FIN set
+    :param opcode: 0x1 text, 0x2 binary
+    """
+    first = 0x80 | opcode | (0x40 if compressed else 0)
+    length = len(payload)
+    if length < 126:
+        header = struct.pack('!BB', first, length)
+    elif length <= 0xFFFF:
+        header = struct.pack('!BBH', first, 126, length)
+    else:
+        header = struct.pack('!BBQ', first, 127, length)
+    return header + payload
+
+
+class SendQueue:
+    """
+    bounded outbound queue of one connection. the next batch of frames is only written when the previous one
+    was handed to the socket, so a slow client collects frames here instead of in tornado's write buffer.
+    a queued frame is dropped when a newer frame with the same key arrives,
+    a client that still gets too far behind is disconnected
+    """
+    __slots__ = ('connection', 'frames', 'size', 'in_flight', 'dropped')
+
+    def __init__(self, connection):
+        self.connection = connection
+        self.frames = deque()  # (frame, frame bytes) not written yet
+        self.size = 0  # bytes in frames
+        self.in_flight = 0  # bytes written to the socket but not sent yet
+        self.dropped = 0
+
+    def put(self, frame):
+        """
+        :return: False if the queue is full and the client should be disconnected
+        """
+        if frame.key is not None:
+            self.drop(frame.key)
+        data = self.connection.encode_frame(frame)
+        self.frames.append((frame, data))
+        self.size += len(data)
+        return self.size + self.in_flight <= CONSTANTS.SEND_QUEUE_MAX_BYTES and \
+            len(self.frames) <= CONSTANTS.SEND_QUEUE_MAX_FRAMES
+
+    def drop(self, key):
+        """
+        removes the queued frames with a key
+        """
+        kept = deque()
+        for frame, data in self.frames:
+            if frame.key == key:
+                self.size -= len(data)
+                self.dropped += 1
+            else:
+                kept.append((frame, data))
+        self.frames = kept
+
+    def flush(self):
+        """
+        writes the queued frames with a single write, unless a write is still in progress
+        """
+        if self.in_flight or not self.frames:
+            return
+        data = b''.join(data for frame, data in self.frames)
+        self.frames.clear()
+        self.size = 0
+        future = self.connection.write_bytes(data)
+        if future is not None:
+            self.in_flight = len(data)
+            tornado.ioloop.IOLoop.current().add_future(future, self._written)
+
+    def _written(self, future):
+        self.in_flight = 0
+        if future.exception() is not None:  # connection closed, on_close unregisters it
+            self.frames.clear()
+            self.size = 0
+        else:
+            self.flush()
+
+    def get_stats(self):
+        return {'frames': len(self.frames), 'bytes': self.size + self.in_flight, 'dropped': self.dropped}
+
+
+class ConnectionRegistry:
+    """
+    websocket connections by player id and broadcast groups of player ids per lobby and per game,
+    messages are published to the members of a group through the backplane (see backplane.py).
+    outgoing messages are encoded into a frame once and queued per connection (see SendQueue),
+    all frames queued during one IOLoop iteration are written to a connection with a single write
+    """
+    players = {}  # {player_id: connection}
+    groups = {}  # {group: set of player ids}
+    memberships = {}  # {player_id: set of groups}
+    queues = {}  # {player_id: SendQueue}
+    pending = set()  # player ids with queued frames
+    flush_scheduled = False
+
+    @staticmethod
+    def register(player_id, connection):
+        ConnectionRegistry.players[player_id] = connection
+        ConnectionRegistry.queues[player_id] = SendQueue(connection)
+
+    @staticmethod
+    def unregister(player_id, connection):
+        """
+        removes the connection of a player, unless the player reconnected in the meantime
+        """
+        if ConnectionRegistry.players.get(player_id) is connection:
+            del ConnectionRegistry.players[player_id]
+            del ConnectionRegistry.queues[player_id]
+            ConnectionRegistry.pending.discard(player_id)
+
+    @staticmethod
+    def get_connection(player_id):
+        return ConnectionRegistry.players.get(player_id)
+
+    @staticmethod
+    def join(group, player_id):
+        ConnectionRegistry.groups.setdefault(group, set()).add(player_id)
+        ConnectionRegistry.memberships.setdefault(player_id, set()).add(group)
+
+    @staticmethod
+    def leave(group, player_id):
+        members = ConnectionRegistry.groups.get(group)
+        if members is not None:
+            members.discard(player_id)
+            if not members:
+                del ConnectionRegistry.groups[group]
+        groups = ConnectionRegistry.memberships.get(player_id)
+        if groups is not None:
+            groups.discard(group)
+            if not groups:
+                del ConnectionRegistry.memberships[player_id]
+
+    @staticmethod
+    def close_group(group):
+        for player_id in list(ConnectionRegistry.groups.get(group, ())):
+            ConnectionRegistry.leave(group, player_id)
+
+    @staticmethod
+    def get_groups(player_id):
+        return ConnectionRegistry.memberships.get(player_id, set())
+
+    @staticmethod
+    def get_members(group, except_player_id=None):
+        """
+        :param group: e.g. lobby_group(quiz_id) or game_group(game_id)
+        :param except_player_id: member that is left out
+        :return: list of the player ids in the group
+        """
+        return [player_id for player_id in ConnectionRegistry.groups.get(group, ()) if player_id != except_player_id]
+
+    @staticmethod
+    def queue(player_id, frame):
+        queue = ConnectionRegistry.queues.get(player_id)
+        if queue is None:
+            return
+        if not queue.put(frame):
+            ConnectionRegistry.evict(player_id)
+            return
+        ConnectionRegistry.pending.add(player_id)
+        if not ConnectionRegistry.flush_scheduled:
+            ConnectionRegistry.flush_scheduled = True
+            tornado.ioloop.IOLoop.current().add_callback(ConnectionRegistry.flush)
+
+    @staticmethod
+    def flush():
+        """
+        writes the queued frames, called once per IOLoop iteration in which something was sent
+        """
+        pending = ConnectionRegistry.pending
+        ConnectionRegistry.pending = set()
+        ConnectionRegistry.flush_scheduled = False
+        for player_id in pending:
+            queue = ConnectionRegistry.queues.get(player_id)
+            if queue is not None:
+                queue.flush()
+
+    @staticmethod
+    def evict(player_id):
+        """
+        disconnects a client whose send queue is full, it can reconnect and resync
+        """
+        connection = ConnectionRegistry.players.get(player_id)
+        logger.warning('send queue of player %s is full, disconnecting', player_id)
+        ConnectionRegistry.unregister(player_id, connection)
+        connection.close(1008, 'send queue full')
+
+    @staticmethod
+    def get_stats():
+        """
+        :return: {player_id: {'frames': queued frames, 'bytes': unsent bytes, 'dropped': superseded frames}}
+        """
+        return {player_id: queue.get_stats() for player_id, queue in ConnectionRegistry.queues.items()}
+
+
+def lobby_group(quiz_id):
+    return 'lobby', quiz_id
+
+
+def game_group(game_id):
+    return 'game', game_id
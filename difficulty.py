@@ -0,0 +1,99 @@
+# -*- coding: utf-8 -*-
+import threading
+from array import array
+import numpy as np
+import CONSTANTS
+from storage import get_storage
+from log import get_logger
+
+logger = get_logger('difficulty')
+
+
+class AnswerStatistics:
+    """
+    counts correct and incorrect answers per question id in compact arrays.
+    recording an answer is an array increment, the counts are written to the question bank by recalibrate()
+    """
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.correct = array('L')
+        self.incorrect = array('L')
+
+    def record(self, question_id, is_correct):
+        """
+        :param question_id: id of the answered question, ids < 1 (unanswered questions) are ignored
+        :param is_correct: True if the answer was correct
+        """
+        question_id = int(question_id)
+        if question_id < 1:
+            return
+        with self.lock:
+            if question_id >= len(self.correct):
+                grow = question_id + 1 - len(self.correct)
+                self.correct.extend([0] * grow)
+                self.incorrect.extend([0] * grow)
+            if is_correct:
+                self.correct[question_id] += 1
+            else:
+                self.incorrect[question_id] += 1
+
+    def take(self):
+        """
+        hands over the counts collected so far and starts counting from zero
+        :return: (correct, incorrect) arrays indexed by question id
+        """
+        with self.lock:
+            counts = (self.correct, self.incorrect)
+            self.correct = array('L')
+            self.incorrect = array('L')
+            return counts
+
+
+def recalibrate(statistics, storage=None):
+    """
+    recomputes dynamicDifficulty of the whole question bank in one vectorized pass.
+    the measured error rate of a question (smoothed with DIFFICULTY_PRIOR_ANSWERS neutral answers) is mapped to the
+    difficulty scale and blended into the current value, weighted by how many answers were counted.
+    changed questions are written back as one batch
+    :param statistics: AnswerStatistics with the answers since the last recalibration
+    :param storage: storage backend, defaults to the configured one
+    :return: amount of questions whose difficulty changed
+    """
+    storage = storage or get_storage()
+    correct, incorrect = statistics.take()
+    if not len(correct):
+        return 0
+    records = storage.all_records('questions')
+    if not records:
+        return 0
+    ids = np.fromiter((record['id'] for record in records), dtype=np.int64, count=len(records))
+    current = np.fromiter((record['dynamicDifficulty'] or 0 for record in records), dtype=np.float64, count=len(records))
+
+    size = max(len(correct), int(ids.max()) + 1)
+    correct_counts = np.zeros(size)
+    incorrect_counts = np.zeros(size)
+    correct_counts[:len(correct)] = np.frombuffer(correct, dtype=np.uint32 if correct.itemsize == 4 else np.uint64)
+    incorrect_counts[:len(incorrect)] = np.frombuffer(incorrect, dtype=np.uint32 if incorrect.itemsize == 4 else np.uint64)
+    correct_counts = correct_counts[ids]
+    incorrect_counts = incorrect_counts[ids]
+    answers = correct_counts + incorrect_counts
+
+    prior = CONSTANTS.DIFFICULTY_PRIOR_ANSWERS
+    error_rate = (incorrect_counts + prior * 0.5) / (answers + prior)
+    target = CONSTANTS.MIN_DIFFICULTY + error_rate * (CONSTANTS.MAX_DIFFICULTY - CONSTANTS.MIN_DIFFICULTY)
+    weight = answers / (answers + CONSTANTS.DIFFICULTY_INERTIA)
+    updated = np.round(current * (1 - weight) + target * weight, 2)
+
+    changed = np.flatnonzero((answers > 0) & (updated != current))
+    if len(changed):
+        new_records = []
+        for index in changed.tolist():
+            record = dict(records[index])
+            record['dynamicDifficulty'] = float(updated[index])
+            new_records.append(record)
+        storage.put_many('questions', new_records)
+    logger.info('recalibrated dynamic difficulty of %d questions', len(changed))
+    return len(changed)
+
+
+answer_statistics = AnswerStatistics()
@@ -0,0 +1,106 @@
+# -*- coding: utf-8 -*-
+import numpy as np
+import CONSTANTS
+
+# initial impact of every effect, all values tbd further
+# further possibilites: freeze other players,
+IMPACTS = {
+    'scoreX2': 0.3,
+    'scoreX5': 0.7,
+    'score/2': 0.5,
+    'shuffle_question': 0.8,
+    'jackpot': 1,
+    'bomb': 0.6,
+    'move_answers': 0.7,
+    'hide_scoreboard': 0.1,
+    'get_points_save': 0.2
+}
+
+
+class ItemDistributor:
+    """
+    chooses the effects that are attached to an answer, one per player.
+    the effects are sorted by impact once, a player gets a random effect whose impact is within
+    RELATIVE_POSITION_DEVIATION of the player's relative position (0 for the leader, towards 1 for the last player),
+    so players behind get the stronger effects. the position is shifted
+    - towards the leader by the impact of the items the player holds (ITEM_HELD_PENALTY),
+    - towards stronger effects for everyone when the scores are far apart and weaker ones when they are close
+      (ITEM_SPREAD_SCALING).
+    ITEM_LIMITS caps the amount of players that hold an effect, e.g. a single jackpot holder.
+    the players come ranked from the game's leaderboard. their positions are computed as one array and their
+    windows are found with two searchsorted calls, O(n log e) for n players and e effects
+    """
+    def __init__(self, impacts=None, seed=None):
+        """
+        :param impacts: {effect: impact}, defaults to IMPACTS
+        :param seed: seed of the random generator, for reproducible distributions
+        """
+        impacts = impacts or IMPACTS
+        self.effects = sorted(impacts, key=impacts.get)
+        self.impacts = np.array([impacts[effect] for effect in self.effects], dtype=np.float64)
+        self.impact_of = dict(impacts)
+        self.limits = {effect: limit for effect, limit in CONSTANTS.ITEM_LIMITS.items() if effect in impacts}
+        self.random = np.random.default_rng(seed)
+
+    def distribute(self, leaderboard, player_items=None):
+        """
+        :param leaderboard: leaderboard.Leaderboard of the game
+        :param player_items: items the players hold, {effect: {player_id: quantity}} as in ItemTable
+        :return: {player_id: effect}, players without an effect in their window get none
+        """
+        n = len(leaderboard)
+        if not n:
+            return {}
+        ranking = leaderboard.top()
+        top = ranking[0][1]
+        spread = (top - ranking[-1][1]) / top if top > 0 else 0
+        shift = CONSTANTS.ITEM_SPREAD_SCALING * (spread - 0.5)
+        held = self.get_held_impact(player_items) if player_items else {}
+        quotas = self.get_quotas(player_items or {})
+        deviation = CONSTANTS.RELATIVE_POSITION_DEVIATION
+        player_ids = [player_id for player_id, score in ranking]
+        positions = np.arange(n, dtype=np.float64) / n + shift
+        if held:
+            positions -= CONSTANTS.ITEM_HELD_PENALTY * np.fromiter((held.get(player_id, 0) for player_id in player_ids),
+                                                                   dtype=np.float64, count=n)
+        lows = np.searchsorted(self.impacts, positions - deviation, 'left')
+        highs = np.searchsorted(self.impacts, positions + deviation, 'right')
+        chosen = lows + (self.random.random(n) * (highs - lows)).astype(np.int64)
+        effects = self.effects
+        distribution = {}
+        for player_id, low, high, index in zip(player_ids, lows.tolist(), highs.tolist(), chosen.tolist()):
+            if low == high:
+                continue
+            effect = effects[index]
+            if effect in quotas:
+                if quotas[effect] > 0:
+                    quotas[effect] -= 1
+                else:  # another effect of the window that has no limit
+                    candidates = [other for other in effects[low:high] if other not in quotas]
+                    if not candidates:
+                        continue
+                    effect = candidates[int(self.random.random() * len(candidates))]
+            distribution[player_id] = effect
+        return distribution
+
+    def get_held_impact(self, player_items):
+        """
+        :return: {player_id: summed impact of the items the player holds}
+        """
+        held = {}
+        for effect, holders in player_items.items():
+            impact = self.impact_of.get(effect, 0)
+            for player_id, quantity in holders.items():
+                if quantity > 0:
+                    held[player_id] = held.get(player_id, 0) + impact * quantity
+        return held
+
+    def get_quotas(self, player_items):
+        """
+        :return: {limited effect: amount of players that may still get it}
+        """
+        return {effect: limit - sum(1 for quantity in player_items.get(effect, {}).values() if quantity > 0)
+                for effect, limit in self.limits.items()}
+
+
+distributor = ItemDistributor()
@@ -0,0 +1,249 @@
+# -*- coding: utf-8 -*-
+import codec
+import os
+import threading
+import CONSTANTS
+from log import get_logger
+
+logger = get_logger('journal')
+
+
+class Journal:
+    """
+    append-only write log next to a json data file (e.g. players.json.journal)
+    every record is written as one json line. fsyncs are batched by a background thread (group commit),
+    so a burst of registrations costs one fsync instead of one file rewrite each. an append returns once the
+    fsync that covers it is done, the writers of a batch wait for the same fsync.
+    compaction folds the journal into the json snapshot and replaces the snapshot by atomic rename.
+
+    a record with an id that already exists replaces the old one, so replaying a journal twice is harmless.
+    this is what makes a crash between replacing the snapshot and deleting the folded journal safe.
+    """
+    def __init__(self, json_path, collection, on_compacted=None):
+        """
+        :param on_compacted: called with the lock held after a compaction replaced the json file,
+                             with the (mtime, size) of the file before and after
+        """
+        self.json_path = json_path
+        self.collection = collection
+        self.journal_path = json_path + '.journal'
+        self.compacting_path = json_path + '.journal.compacting'
+        self.on_compacted = on_compacted
+        self.lock = threading.RLock()
+        self._pending = threading.Condition(self.lock)  # the flusher waits for records to sync
+        self._changed = threading.Condition(self.lock)  # writers wait for their fsync
+        self._idle = False  # the flusher waits for records, it is not collecting a batch
+        self._fd = None
+        self._written = 0  # number of records written to the file
+        self._synced = 0  # number of records known to be on disk
+        self._size = 0  # records in the journal since the last compaction
+        self._compaction = None
+        self._flusher = None
+        self._closed = False
+
+    def append(self, record):
+        """
+        appends a record to the journal and blocks until it is on disk
+        :param record: dict with at least an 'id' key
+        """
+        self.wait(self.write(record))
+
+    def append_many(self, records):
+        """
+        appends records as one journal line, so after a crash either all or none of them are replayed
+        """
+        self.append({'batch': records})
+
+    def write(self, record):
+        """
+        writes a record to the journal without waiting for its fsync, it is in the os page cache when this returns
+        :return: position of the record, see wait()
+        """
+        line = codec.dumps(record) + b'\n'
+        with self.lock:
+            self._open()
+            os.write(self._fd, line)
+            self._written += 1
+            self._size += 1
+            # a flusher that collects a batch is only woken up once the batch is full
+            if self._idle or self._written - self._synced >= CONSTANTS.JOURNAL_FSYNC_BATCH:
+                self._pending.notify()
+            if self._size >= CONSTANTS.JOURNAL_COMPACT_THRESHOLD:
+                self.compact_in_background()
+            return self._written
+
+    def wait(self, position):
+        """
+        blocks until the record at position (see write()) has been fsynced. the lock is released while waiting,
+        also if the caller holds it, so other writers can join the group commit
+        """
+        with self.lock:
+            while self._synced < position and not self._closed:
+                self._changed.wait()
+
+    def sync(self):
+        """
+        blocks until every record appended so far has been fsynced, without waiting for a batch to fill up
+        """
+        with self.lock:
+            target = self._written
+            self._pending.notify()
+            while self._synced < target and not self._closed:
+                self._changed.wait()
+
+    def replay(self):
+        """
+        reads all records that are not yet part of the snapshot, oldest first
+        :return: list of record dicts
+        """
+        with self.lock:
+            records = []
+            for path in (self.compacting_path, self.journal_path):
+                records.extend(self._read(path))
+            return records
+
+    def compact_in_background(self):
+        with self.lock:
+            if self._compaction is None or not self._compaction.is_alive():
+                self._compaction = threading.Thread(target=self.compact, name='compaction ' + self.json_path, daemon=True)
+                self._compaction.start()
+
+    def compact(self):
+        """
+        folds the journal into the snapshot. the journal is first renamed to *.compacting so new records
+        can be appended while the snapshot is rewritten outside of the lock
+        """
+        with self.lock:
+            if not os.path.exists(self.compacting_path):
+                if self._size == 0 and not os.path.exists(self.journal_path):
+                    return
+                self._rotate()
+            records = self._read(self.compacting_path)
+        before = _stat(self.json_path)
+        with open(self.json_path, 'rb') as f:
+            data = codec.load(f)
+        apply_records(data, self.collection, records)
+        tmp_path = self.json_path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            codec.dump(data, f)
+            f.flush()
+            os.fsync(f.fileno())
+        with self.lock:
+            os.replace(tmp_path, self.json_path)
+            _fsync_directory(self.json_path)
+            os.remove(self.compacting_path)
+            if self.on_compacted is not None:
+                self.on_compacted(before, _stat(self.json_path))
+        logger.info('compacted %d journal records into %s', len(records), self.json_path)
+
+    def close(self):
+        with self.lock:
+            self.sync()
+            self._closed = True
+            self._pending.notify()
+            self._changed.notify_all()
+            if self._fd is not None:
+                os.close(self._fd)
+                self._fd = None
+
+    def _open(self):
+        if self._fd is None:
+            self._fd = os.open(self.journal_path, os.O_WRONLY | os.O_APPEND | os.O_CREAT, 0o644)
+            self._closed = False
+        if self._flusher is None or not self._flusher.is_alive():
+            self._flusher = threading.Thread(target=self._flush_loop, name='journal ' + self.json_path, daemon=True)
+            self._flusher.start()
+
+    def _rotate(self):
+        """
+        moves the current journal aside for compaction, must be called with the lock held
+        """
+        if self._fd is not None:
+            os.fsync(self._fd)
+            os.close(self._fd)
+            self._fd = None
+            self._synced = self._written
+            self._changed.notify_all()
+        if os.path.exists(self.journal_path):
+            os.replace(self.journal_path, self.compacting_path)
+        else:
+            open(self.compacting_path, 'w').close()
+        self._size = 0
+
+    def _flush_loop(self):
+        while True:
+            with self.lock:
+                self._idle = True
+                while self._synced == self._written and not self._closed:
+                    self._pending.wait()
+                self._idle = False
+                if self._closed:
+                    return
+                # give concurrent writers a short window to join this commit
+                if self._written - self._synced < CONSTANTS.JOURNAL_FSYNC_BATCH:
+                    self._pending.wait(CONSTANTS.JOURNAL_FSYNC_INTERVAL)
+                fd = self._fd
+                target = self._written
+            if fd is not None:
+                try:
+                    os.fsync(fd)
+                except OSError:  # descriptor was closed by a rotation, which fsynced it itself
+                    pass
+            with self.lock:
+                self._synced = max(self._synced, target)
+                self._changed.notify_all()
+
+    @staticmethod
+    def _read(path):
+        records = []
+        if not os.path.exists(path):
+            return records
+        with open(path, 'rb') as f:
+            for line in f:
+                try:
+                    entry = codec.loads(line)
+                except ValueError:
+                    # a torn last line from a crash during append, the record was never acknowledged
+                    logger.warning('skipped unreadable journal line in %s', path)
+                    continue
+                if 'batch' in entry:
+                    records.extend(entry['batch'])
+                else:
+                    records.append(entry)
+        return records
+
+
+def apply_records(data, collection, records):
+    """
+    merges journal records into a parsed json document, replacing records with the same id
+    :param data: parsed json file, e.g. {'highest_id': 4, 'players': [...]}
+    :param collection: key of the record list
+    :param records: records to merge
+    """
+    positions = {record['id']: index for index, record in enumerate(data[collection])}
+    for record in records:
+        if record['id'] in positions:
+            data[collection][positions[record['id']]] = record
+        else:
+            positions[record['id']] = len(data[collection])
+            data[collection].append(record)
+        if record['id'] > data['highest_id']:
+            data['highest_id'] = record['id']
+
+
+def _stat(path):
+    stat = os.stat(path)
+    return stat.st_mtime_ns, stat.st_size
+
+
+def _fsync_directory(path):
+    try:
+        fd = os.open(os.path.dirname(os.path.abspath(path)), os.O_RDONLY)
+    except OSError:
+        return
+    try:
+        os.fsync(fd)
+    except OSError:
+        pass
+    finally:
+        os.close(fd)
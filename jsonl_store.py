@@ -0,0 +1,362 @@
+# -*- coding: utf-8 -*-
+"""
+questions stored as json lines (one question per line) with a sidecar offset index,
+single questions are decoded straight from a memory map of the file instead of parsing the whole bank.
+records that are only ever added, like the results of finished games, are kept in an append-only json lines log
+
+convert questions.json:
+$ python3 jsonl_store.py convert [--source questions.json] [--target questions.jsonl]
+"""
+import argparse
+import atexit
+import codec
+import mmap
+import os
+import struct
+import threading
+import time
+import zlib
+from array import array
+import CONSTANTS
+from log import get_logger
+
+logger = get_logger('jsonl_store')
+
+# index entry of one line: id, byte offset, length without the newline, crc32 of the topic and of the questioning
+ENTRY = struct.Struct('<qqiII')
+
+
+class JsonLinesQuestionStore:
+    """
+    the sidecar index (<file>.idx) is append-only, it has a fixed-width entry (ENTRY) for every line of the file
+    in the same order, so it is extended together with the file and never rewritten.
+    replacing a question appends a new line, a later line of an id replaces the earlier one; the old line stays
+    until the next convert. topics and questionings are looked up by their crc32 and checked on the record.
+    lines appended after the last index entry are indexed when the store is opened, an index that does not match
+    the file is rebuilt from the file
+    """
+    def __init__(self, jsonl_path):
+        self.jsonl_path = jsonl_path
+        self.index_path = jsonl_path + '.idx'
+        self.lock = threading.RLock()
+        self.version = 0
+        self._offsets = array('q')  # offset of the line of id i, -1 if there is no such id
+        self._lengths = array('l')
+        self._topic_crcs = array('L')  # crc32 of the topic of id i
+        self._questioning_crcs = array('L')
+        self._topics = {}  # {crc32 of topic: [ids]}
+        self._questionings = {}  # {crc32 of questioning: [ids]}
+        self._size = 0  # bytes of the file covered by the index
+        self._mmap = None
+        self._file = None
+        self._index_file = None
+        self._signature = None
+        self._last_check = 0
+        self.load()
+        atexit.register(self.close)
+
+    def load(self):
+        with self.lock:
+            self._close_files()
+            self._offsets, self._lengths = array('q'), array('l')
+            self._topic_crcs, self._questioning_crcs = array('L'), array('L')
+            self._topics, self._questionings, self._size = {}, {}, 0
+            if not os.path.exists(self.jsonl_path):
+                open(self.jsonl_path, 'w').close()  # an index without data describes nothing
+            raw = b''
+            if os.path.exists(self.index_path):
+                with open(self.index_path, 'rb') as f:
+                    raw = f.read()
+            entries = len(raw) // ENTRY.size  # a torn last entry of a crash is dropped
+            if not self._check_index(raw, entries):
+                logger.warning('index %s does not match the data, rebuilding it', self.index_path)
+                entries = 0
+            for id, offset, length, topic_crc, questioning_crc in ENTRY.iter_unpack(raw[:entries * ENTRY.size]):
+                self._add(id, offset, length, topic_crc, questioning_crc)
+            self._size = self._covered(raw, entries)
+            self._index_file = open(self.index_path, 'r+b' if os.path.exists(self.index_path) else 'w+b')
+            self._index_file.truncate(entries * ENTRY.size)
+            self._index_file.seek(0, os.SEEK_END)
+            self._index_tail()
+            self._close_map()
+            self._signature = self._stat()
+            self.version += 1
+
+    def get_highest_id(self):
+        return len(self._offsets) - 1
+
+    def get(self, id):
+        """
+        :return: question record or None
+        """
+        self.refresh()
+        id = int(id)
+        with self.lock:
+            if id < 0 or id >= len(self._offsets) or self._offsets[id] < 0:
+                return None
+            return self._read(self._offsets[id], self._lengths[id])
+
+    def find_by_questioning(self, questioning):
+        self.refresh()
+        for id in self._questionings.get(_crc(questioning), []):
+            record = self.get(id)
+            if record is not None and record['questioning'] == questioning:
+                return record
+        return None
+
+    def find_by_topic(self, topic):
+        self.refresh()
+        records = [self.get(id) for id in self._topics.get(_crc(topic), [])]
+        return [record for record in records if record is not None and record['topic'] == topic]
+
+    def all(self):
+        self.refresh()
+        with self.lock:
+            return [self._read(offset, length) for offset, length in zip(self._offsets, self._lengths) if offset >= 0]
+
+    def insert(self, record):
+        with self.lock:
+            self.refresh()
+            record['id'] = len(self._offsets) if len(self._offsets) > 0 else 1
+            self._append([record])
+            return record['id']
+
+    def put(self, record):
+        with self.lock:
+            self.refresh()
+            self._append([record])
+
+    def put_many(self, records):
+        """
+        appends the new versions of many questions with a single write
+        """
+        with self.lock:
+            self.refresh()
+            self._append(records)
+
+    def refresh(self):
+        """
+        reloads the index if the file was changed by someone else, checked at most once per REPOSITORY_CHECK_INTERVAL
+        """
+        now = time.monotonic()
+        if now - self._last_check < CONSTANTS.REPOSITORY_CHECK_INTERVAL:
+            return
+        with self.lock:
+            self._last_check = now
+            if self._signature != self._stat():
+                self.load()
+
+    def close(self):
+        with self.lock:
+            self._close_files()
+
+    def _append(self, records):
+        lines = [codec.dumps(record) + b'\n' for record in records]
+        if self._file is None:
+            self._file = open(self.jsonl_path, 'ab')
+        self._file.write(b''.join(lines))
+        self._file.flush()  # the data before its index entries, an index ahead of the data is rebuilt
+        entries = []
+        for record, line in zip(records, lines):
+            entries.append(self._add_record(record, self._size, len(line) - 1))
+            self._size += len(line)
+        self._write_entries(entries)
+        self._close_map()  # the map does not cover the new line
+        self._signature = self._stat()
+        self.version += 1
+
+    def _add_record(self, record, offset, length):
+        """
+        :return: packed index entry of the record
+        """
+        entry = (record['id'], offset, length, _crc(record['topic']), _crc(record['questioning']))
+        self._add(*entry)
+        return ENTRY.pack(*entry)
+
+    def _add(self, id, offset, length, topic_crc, questioning_crc):
+        while len(self._offsets) <= id:
+            self._offsets.append(-1)
+            self._lengths.append(0)
+            self._topic_crcs.append(0)
+            self._questioning_crcs.append(0)
+        if self._offsets[id] >= 0:  # replaced by a later line
+            self._topics[self._topic_crcs[id]].remove(id)
+            self._questionings[self._questioning_crcs[id]].remove(id)
+        self._offsets[id] = offset
+        self._lengths[id] = length
+        self._topic_crcs[id] = topic_crc
+        self._questioning_crcs[id] = questioning_crc
+        self._topics.setdefault(topic_crc, []).append(id)
+        self._questionings.setdefault(questioning_crc, []).append(id)
+
+    def _check_index(self, raw, entries):
+        """
+        True if the first entries of the raw index describe consecutive lines within the file and the last one
+        points at a line of its id
+        """
+        if entries == 0:
+            return True
+        size = 0
+        for id, offset, length, topic_crc, questioning_crc in ENTRY.iter_unpack(raw[:entries * ENTRY.size]):
+            if offset != size:
+                return False
+            size = offset + length + 1
+        if size > os.path.getsize(self.jsonl_path):
+            return False
+        with open(self.jsonl_path, 'rb') as f:
+            f.seek(offset)
+            line = f.read(length + 1)
+        try:
+            return line.endswith(b'\n') and codec.loads(line)['id'] == id
+        except (ValueError, KeyError, TypeError):
+            return False
+
+    @staticmethod
+    def _covered(raw, entries):
+        """
+        :return: bytes of the file covered by the first entries of the raw index
+        """
+        if entries == 0:
+            return 0
+        id, offset, length, topic_crc, questioning_crc = ENTRY.unpack_from(raw, (entries - 1) * ENTRY.size)
+        return offset + length + 1
+
+    def _index_tail(self):
+        """
+        indexes lines that were appended after the last index entry
+        """
+        entries = []
+        with open(self.jsonl_path, 'rb') as f:
+            f.seek(self._size)
+            for line in f:
+                if line.endswith(b'\n'):
+                    entries.append(self._add_record(codec.loads(line), self._size, len(line) - 1))
+                    self._size += len(line)
+        self._write_entries(entries)
+
+    def _write_entries(self, entries):
+        if entries:
+            self._index_file.write(b''.join(entries))
+            self._index_file.flush()
+
+    def _read(self, offset, length):
+        if self._mmap is None:
+            if self._size == 0:
+                return None
+            with open(self.jsonl_path, 'rb') as f:
+                self._mmap = mmap.mmap(f.fileno(), self._size, access=mmap.ACCESS_READ)
+        return codec.loads(self._mmap[offset:offset + length])
+
+    def _close_map(self):
+        if self._mmap is not None:
+            self._mmap.close()
+            self._mmap = None
+
+    def _close_files(self):
+        self._close_map()
+        for file in (self._file, self._index_file):
+            if file is not None:
+                file.close()
+        self._file = self._index_file = None
+
+    def _stat(self):
+        stat = os.stat(self.jsonl_path)
+        return stat.st_mtime_ns, stat.st_size
+
+
+class JsonLinesLog:
+    """
+    append-only json lines file without an in-memory copy, only the highest id is kept.
+    every insert is flushed and fsynced, reads scan the file (a later line of the same id replaces the earlier one)
+    """
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.version = 0
+        self._highest_id = None  # read from the file on the first insert
+
+    def get(self, id):
+        return self.find('id', int(id))
+
+    def find(self, field, value):
+        """
+        :return: record with the lowest id whose field equals value or None
+        """
+        return next((record for record in self.all() if record[field] == value), None)
+
+    def find_all(self, field, value):
+        return [record for record in self.all() if record[field] == value]
+
+    def all(self):
+        """
+        :return: list of all records, ordered by id
+        """
+        records = {}
+        for record in self._scan():
+            records[record['id']] = record
+        return [records[id] for id in sorted(records)]
+
+    def insert(self, record):
+        with self.lock:
+            if self._highest_id is None:
+                self._highest_id = max((record['id'] for record in self._scan()), default=0)
+            record['id'] = self._highest_id + 1
+            self._append([record])
+            return record['id']
+
+    def put(self, record):
+        self.put_many([record])
+
+    def put_many(self, records):
+        with self.lock:
+            self._append(records)
+
+    def get_version(self):
+        return self.version
+
+    def _append(self, records):
+        with open(self.path, 'ab') as f:
+            f.write(b''.join(codec.dumps(record) + b'\n' for record in records))
+            f.flush()
+            os.fsync(f.fileno())
+        if self._highest_id is not None:
+            self._highest_id = max([self._highest_id] + [record['id'] for record in records])
+        self.version += 1
+
+    def _scan(self):
+        if not os.path.exists(self.path):
+            return
+        with open(self.path, 'rb') as f:
+            for line in f:
+                if line.endswith(b'\n'):  # a torn last line of a crash is skipped
+                    yield codec.loads(line)
+
+
+def _crc(text):
+    return zlib.crc32(text.encode('utf-8'))
+
+
+def convert(source, target):
+    """
+    writes the questions of a questions.json file as json lines and builds the index
+    """
+    with open(source, 'rb') as f:
+        questions = codec.load(f)['questions']
+    with open(target, 'wb') as f:
+        for question in questions:
+            f.write(codec.dumps(question) + b'\n')
+    if os.path.exists(target + '.idx'):
+        os.remove(target + '.idx')
+    JsonLinesQuestionStore(target).close()  # builds the index
+    print('converted ' + str(len(questions)) + ' questions to ' + target)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='json lines question store')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    convert_parser = subparsers.add_parser('convert', help='convert questions.json to json lines')
+    convert_parser.add_argument('--source', default='questions.json')
+    convert_parser.add_argument('--target', default=CONSTANTS.QUESTIONS_JSONL_PATH)
+    args = parser.parse_args()
+    if args.command == 'convert':
+        convert(args.source, args.target)
@@ -0,0 +1,178 @@
+# -*- coding: utf-8 -*-
+from bisect import bisect_left, insort
+import CONSTANTS
+
+
+class Leaderboard:
+    """
+    scores of the players of a game, kept ordered by score (ties by player id) while they change.
+    the players are kept as keys (-score, player_id) in a sorted list of buckets of LEADERBOARD_BUCKET_SIZE to
+    2 * LEADERBOARD_BUCKET_SIZE keys, a Fenwick tree over the bucket lengths translates between ranks and buckets.
+    updating a score and the rank of a player cost O(log n), the top k players or the neighbourhood of a player O(k).
+    ranks start at 0 for the leader
+    """
+    def __init__(self, scores=None, bucket_size=None):
+        """
+        :param scores: initial {player_id: score}
+        :param bucket_size: defaults to LEADERBOARD_BUCKET_SIZE
+        """
+        self.bucket_size = bucket_size or CONSTANTS.LEADERBOARD_BUCKET_SIZE
+        self.scores = {}  # {player_id: score}, do not change it directly
+        self.buckets = []
+        self.maxes = []  # last key of every bucket
+        self.tree = [0]  # Fenwick tree of the bucket lengths, 1-based
+        if scores:
+            self.reset(scores)
+
+    def reset(self, scores):
+        self.scores = dict(scores)
+        keys = sorted((-score, player_id) for player_id, score in self.scores.items())
+        self.buckets = [keys[i:i + self.bucket_size] for i in range(0, len(keys), self.bucket_size)]
+        self.maxes = [bucket[-1] for bucket in self.buckets]
+        self._build_tree()
+
+    def __len__(self):
+        return len(self.scores)
+
+    def __contains__(self, player_id):
+        return player_id in self.scores
+
+    def get_score(self, player_id):
+        return self.scores[player_id]
+
+    def set(self, player_id, score):
+        if player_id in self.scores:
+            self._remove((-self.scores[player_id], player_id))
+        self.scores[player_id] = score
+        self._insert((-score, player_id))
+
+    def add(self, player_id, points):
+        """
+        adds points to the score of a player, players that are not on the board yet start at 0
+        """
+        self.set(player_id, self.scores.get(player_id, 0) + points)
+
+    def remove(self, player_id):
+        self._remove((-self.scores.pop(player_id), player_id))
+
+    def rank(self, player_id):
+        """
+        :return: rank of a player, 0 for the leader
+        """
+        key = (-self.scores[player_id], player_id)
+        index = bisect_left(self.maxes, key)
+        return self._prefix(index) + bisect_left(self.buckets[index], key)
+
+    def top(self, k=None):
+        """
+        :return: list of (player_id, score) of the k best players, all players if k is None
+        """
+        return self.slice(0, len(self.scores) if k is None else k)
+
+    def around(self, player_id, k):
+        """
+        :return: (rank of the player, list of (player_id, score) of the k players before, the player and the
+                 k players after it)
+        """
+        rank = self.rank(player_id)
+        return rank, self.slice(max(0, rank - k), rank + k + 1)
+
+    def slice(self, start, stop):
+        """
+        :return: list of (player_id, score) of the ranks start to stop - 1
+        """
+        stop = min(stop, len(self.scores))
+        if start >= stop:
+            return []
+        index, offset = self._locate(start)
+        entries = []
+        remaining = stop - start
+        while remaining > 0:
+            keys = self.buckets[index][offset:offset + remaining]
+            entries.extend((player_id, -score) for score, player_id in keys)
+            remaining -= len(keys)
+            index += 1
+            offset = 0
+        return entries
+
+    def _insert(self, key):
+        if not self.buckets:
+            self.buckets.append([key])
+            self.maxes.append(key)
+            self._build_tree()
+            return
+        index = bisect_left(self.maxes, key)
+        if index == len(self.buckets):  # behind the last key
+            index -= 1
+            self.maxes[index] = key
+        bucket = self.buckets[index]
+        insort(bucket, key)
+        if len(bucket) > 2 * self.bucket_size:
+            self.buckets[index:index + 1] = [bucket[:self.bucket_size], bucket[self.bucket_size:]]
+            self.maxes[index:index + 1] = [bucket[self.bucket_size - 1], bucket[-1]]
+            self._build_tree()
+        else:
+            self._update_tree(index, 1)
+
+    def _remove(self, key):
+        index = bisect_left(self.maxes, key)
+        bucket = self.buckets[index]
+        del bucket[bisect_left(bucket, key)]
+        if len(bucket) >= self.bucket_size // 2 or len(self.buckets) == 1:
+            if bucket:
+                self.maxes[index] = bucket[-1]
+                self._update_tree(index, -1)
+            else:
+                del self.buckets[index], self.maxes[index]
+                self._build_tree()
+            return
+        # merge the small bucket with a neighbour, split again if that got too large
+        if index == len(self.buckets) - 1:
+            index -= 1
+        merged = self.buckets[index] + self.buckets[index + 1]
+        if len(merged) > 2 * self.bucket_size:
+            half = len(merged) // 2
+            self.buckets[index:index + 2] = [merged[:half], merged[half:]]
+            self.maxes[index:index + 2] = [merged[half - 1], merged[-1]]
+        else:
+            self.buckets[index:index + 2] = [merged]
+            self.maxes[index:index + 2] = [merged[-1]]
+        self._build_tree()
+
+    def _build_tree(self):
+        tree = [0] + [len(bucket) for bucket in self.buckets]
+        for i in range(1, len(tree)):
+            parent = i + (i & -i)
+            if parent < len(tree):
+                tree[parent] += tree[i]
+        self.tree = tree
+
+    def _update_tree(self, index, delta):
+        i = index + 1
+        while i < len(self.tree):
+            self.tree[i] += delta
+            i += i & -i
+
+    def _prefix(self, index):
+        """
+        :return: amount of keys in the buckets before the bucket index
+        """
+        total = 0
+        while index > 0:
+            total += self.tree[index]
+            index -= index & -index
+        return total
+
+    def _locate(self, rank):
+        """
+        :return: (bucket index, offset in the bucket) of a rank
+        """
+        index = 0
+        step = 1 << (len(self.tree) - 1).bit_length()
+        while step:
+            nxt = index + step
+            if nxt < len(self.tree) and self.tree[nxt] <= rank:
+                index = nxt
+                rank -= self.tree[nxt]
+            step >>= 1
+        return index, rank
@@ -0,0 +1,152 @@
+# -*- coding: utf-8 -*-
+"""
+logging of the server. modules log through get_logger('<module name>'), records are handed to a bounded queue and written
+to stderr by a background thread, so the event loop never waits for the terminal.
+high volume events (e.g. every incoming message) are logged through get_traffic_logger(), which samples and rate limits.
+levels can be changed at runtime with set_level()
+"""
+import atexit
+import logging
+import logging.handlers
+import queue
+import threading
+import time
+import CONSTANTS
+
+ROOT = 'quizgame'
+
+_listener = None
+
+
+class DroppingQueueHandler(logging.handlers.QueueHandler):
+    """
+    QueueHandler that drops records instead of blocking or raising when the queue is full
+    """
+    def __init__(self, record_queue):
+        super().__init__(record_queue)
+        self.dropped = 0
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.dropped += 1
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    lets at most rate records per second through (token bucket with a burst of one second),
+    the amount of suppressed records is appended to the next record that passes
+    """
+    def __init__(self, rate):
+        super().__init__()
+        self.rate = rate
+        self.tokens = rate
+        self.last = time.monotonic()
+        self.suppressed = 0
+        self.lock = threading.Lock()
+
+    def filter(self, record):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.rate, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            if self.tokens < 1:
+                self.suppressed += 1
+                return False
+            self.tokens -= 1
+            if self.suppressed:
+                record.msg = str(record.msg) + ' (%d similar suppressed)' % self.suppressed
+                self.suppressed = 0
+            return True
+
+
+class SamplingFilter(logging.Filter):
+    """
+    lets every n-th record through
+    """
+    def __init__(self, n):
+        super().__init__()
+        self.n = n
+        self.count = 0
+
+    def filter(self, record):
+        self.count += 1
+        return (self.count - 1) % self.n == 0
+
+
+def get_logger(name):
+    """
+    :param name: module name, e.g. 'logic'
+    """
+    return logging.getLogger(ROOT + '.' + name)
+
+
+def get_traffic_logger(name):
+    """
+    logger for high volume events, keeps every LOG_TRAFFIC_SAMPLE-th record and at most LOG_TRAFFIC_RATE per second
+    """
+    logger = get_logger(name + '.traffic')
+    if not logger.filters:
+        if CONSTANTS.LOG_TRAFFIC_SAMPLE > 1:
+            logger.addFilter(SamplingFilter(CONSTANTS.LOG_TRAFFIC_SAMPLE))
+        logger.addFilter(RateLimitFilter(CONSTANTS.LOG_TRAFFIC_RATE))
+    return logger
+
+
+def setup(level=None, stream=None):
+    """
+    starts the background writer, call once at startup
+    :param level: level name, defaults to LOG_LEVEL
+    :param stream: where the records are written, defaults to stderr
+    """
+    global _listener
+    if _listener is not None:
+        return
+    stream_handler = logging.StreamHandler(stream)
+    stream_handler.setFormatter(logging.Formatter(CONSTANTS.LOG_FORMAT))
+    record_queue = queue.Queue(CONSTANTS.LOG_QUEUE_SIZE)
+    queue_handler = DroppingQueueHandler(record_queue)
+    root = logging.getLogger(ROOT)
+    root.addHandler(queue_handler)
+    root.propagate = False
+    root.setLevel(level or CONSTANTS.LOG_LEVEL)
+    tornado_logger = logging.getLogger('tornado')  # tornado's access log would log every request
+    tornado_logger.addHandler(queue_handler)
+    tornado_logger.propagate = False
+    tornado_logger.setLevel(logging.WARNING)
+    _listener = logging.handlers.QueueListener(record_queue, stream_handler, respect_handler_level=True)
+    _listener.start()
+    atexit.register(_listener.stop)
+
+
+def set_level(level, name=None):
+    """
+    changes the level at runtime
+    :param level: level name, e.g. 'DEBUG'
+    :param name: module whose level is changed, all modules if None
+    :return: False if the level is unknown
+    """
+    if not isinstance(logging.getLevelName(level), int):
+        return False
+    logging.getLogger(ROOT if name is None else ROOT + '.' + name).setLevel(level)
+    return True
+
+
+def get_levels():
+    """
+    :return: {logger name: level name} of the loggers whose level was set
+    """
+    levels = {ROOT: logging.getLevelName(logging.getLogger(ROOT).level)}
+    for name, logger in logging.Logger.manager.loggerDict.items():
+        if name.startswith(ROOT + '.') and isinstance(logger, logging.Logger) and logger.level:
+            levels[name] = logging.getLevelName(logger.level)
+    return levels
+
+
+def get_dropped():
+    """
+    :return: records dropped because the queue was full
+    """
+    return sum(handler.dropped for handler in logging.getLogger(ROOT).handlers
+               if isinstance(handler, DroppingQueueHandler))
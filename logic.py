@@ -1,17 +1,26 @@
 # -*- coding: utf-8 -*-
-import json
+import codec
+import itertools
 import random
 import warnings
 import CONSTANTS
+from backplane import get_backplane
+from connections import ConnectionRegistry, lobby_group, game_group
+from items import distributor
+from leaderboard import Leaderboard
+from timerwheel import timers
 from model import *
+from log import get_logger
+
+logger = get_logger('logic')
 
 
 class Lobby:
-    def __init__(self, quiz, first_player, socket):
-        print('Created new Lobby')
+    def __init__(self, quiz, first_player):
+        logger.debug('created lobby for quiz %s', quiz.get_id())
         self.players = []
-        self.socket = socket
         self.quiz = quiz
+        self.group = lobby_group(quiz.get_id())
         self.protocol = Protocol(self.quiz.get_id())
         self.add_player(first_player)
 
@@ -22,8 +31,9 @@ class Lobby:
         self.players = players
 
     def add_player(self, player):
-        print('Added Player ' + str(player.get_id()) + ' to lobby')
+        logger.debug('added player %s to lobby', player.get_id())
         self.players.append(player)
+        ConnectionRegistry.join(self.group, player.get_id())
         self.protocol.add_player(player.get_id())
         self.protocol.put(player.get_id(), 'joined_lobby', self.quiz.get_id())
         if self.has_required_players():
@@ -34,32 +44,34 @@ class Lobby:
     def remove_player(self, player):
         if player in self.players:
             self.players.remove(player)
-            print('removed player ' + str(player.get_id()) + ' from lobby')
+            ConnectionRegistry.leave(self.group, player.get_id())
+            logger.debug('removed player %s from lobby', player.get_id())
             self.send_lobby_state_to_players()
 
     def has_required_players(self):
         return len(self.players) >= self.quiz.get_min_participants()  # TODO when quiz model implemented: make this value generic
 
     def send_lobby_state_to_players(self):
-        msg = json.dumps({'type': 'lobby',
-                          'lobby': [player.get_id() for player in self.players],
-                          'nicks': [player.get_nickname() for player in self.players]})
+        msg = {'type': 'lobby',
+               'lobby': [player.get_id() for player in self.players],
+               'nicks': [player.get_nickname() for player in self.players]}
 
-        self.notify_players(msg)
+        self.notify_players(msg, key=self.group)  # only the latest lobby state matters
 
     def open_game(self):
-        print('opening game for ' + str(len(self.players)) + ' players')
-        GamePool.start_game(self.quiz, self.players, self.socket, self.protocol)
+        logger.info('opening game for %d players', len(self.players))
+        GamePool.start_game(self.quiz, self.players, self.protocol)
         self.close_lobby()
 
     def close_lobby(self):
         for id, lobby in list(LobbyPool.lobbies.items()):
             if lobby == self:
                 del LobbyPool.lobbies[id]
-                print("closed lobby")
+                logger.debug('closed lobby')
+        ConnectionRegistry.close_group(self.group)
 
-    def notify_players(self, message):
-        self.socket.notify_clients(message)
+    def notify_players(self, message, key=None):
+        get_backplane().broadcast(self.group, message, key=key)
 
     def __eq__(self, other):
         if isinstance(other, self.__class__):
@@ -74,10 +86,14 @@ class LobbyPool:
     lobbies = {}
 
     @staticmethod
-    def join_lobby(player, socket, quiz_id=1):  # TODO update quiz_id when quiz model exists, for now leave this as 1!
+    def join_lobby(player, quiz_id=1, quiz=None):  # TODO update quiz_id when quiz model exists, for now leave this as 1!
+        """
+        :param quiz: the quiz, needed if it has no lobby yet. the caller loads it, e.g. with get_quiz_async
+        """
         if quiz_id not in LobbyPool.lobbies:
-            quiz = get_quiz(quiz_id)
-            lobby = Lobby(quiz, player, socket)
+            if quiz is None:
+                raise ValueError('quiz %s has no lobby and was not loaded' % quiz_id)
+            lobby = Lobby(quiz, player)
             LobbyPool.lobbies[quiz_id] = lobby
         else:
             LobbyPool.lobbies[quiz_id].add_player(player)
@@ -89,52 +105,94 @@ class LobbyPool:
 
     @staticmethod
     def leave_lobby(player, quiz_id=1):
-        if LobbyPool.lobbies[quiz_id]:
-            LobbyPool.lobbies[quiz_id].remove_player(player)
-            if not LobbyPool.lobbies[quiz_id].get_players():
+        lobby = LobbyPool.lobbies.get(quiz_id)
+        if lobby is not None:
+            lobby.remove_player(player)
+            if not lobby.get_players():
                 del LobbyPool.lobbies[quiz_id]
 
 
+# states of a game
+LOBBY = 'lobby'  # waiting for players in the LobbyPool, or created from a full lobby and not started yet
+RUNNING = 'running'
+FINISHED = 'finished'  # results are sent and stored, late messages of the players are still answered
+ARCHIVED = 'archived'  # removed from the GamePool
+
+
 class GamePool:
-    games = {}
+    games = {}  # running and finished games
+    ids = itertools.count()  # game ids are never reused, so a late message can not reach a newer game
 
     @staticmethod
-    def start_game(quiz, players, socket, protocol):
-        for id in range(0, 1000):
-            if id not in GamePool.games:
-                game = Game(id, quiz, players, socket, protocol)
-                GamePool.games[id] = game
-                GamePool.games[id].start()
-                break
+    def start_game(quiz, players, protocol):
+        id = next(GamePool.ids)
+        game = Game(id, quiz, players, protocol)
+        GamePool.games[id] = game
+        game.start()
         return id
 
+    @staticmethod
+    def finish_game(game):
+        """
+        the game is archived after GAME_ARCHIVE_DELAY
+        """
+        timers.schedule(CONSTANTS.GAME_ARCHIVE_DELAY, GamePool.archive_game, game.get_id())
+
+    @staticmethod
+    def archive_game(game_id):
+        game = GamePool.games.pop(game_id, None)
+        if game is not None:
+            game.state = ARCHIVED
+            get_backplane().release(game.group, game.player_ids)
+            logger.debug('archived game %s', game_id)
+
+    @staticmethod
+    def get_stats():
+        """
+        :return: {state: amount of games}, the open lobbies are the games in the LOBBY state
+        """
+        stats = {LOBBY: len(LobbyPool.lobbies), RUNNING: 0, FINISHED: 0}
+        for game in GamePool.games.values():
+            stats[game.state] += 1
+        return stats
+
     @staticmethod
     def get_game(game_id):
         return GamePool.games[game_id] if game_id in GamePool.games else None
 
     @staticmethod
-    def remove_game(game_id):
-        if game_id in GamePool.games:
-            del GamePool.games[game_id]
+    def get_player_game(game_id, player_id):
+        """
+        :return: the game if the player plays in it, None otherwise, e.g. for a game of another node with the same id
+        """
+        game = GamePool.games.get(game_id)
+        return game if game is not None and player_id in game.scoreboard else None
 
 
 class Game:
-    def __init__(self, id, quiz, players, socket, protocol):
+    def __init__(self, id, quiz, players, protocol):
         self.id = id
+        self.state = LOBBY
+        self.group = game_group(id)
         self.players = players
         self.quiz = quiz
         self.protocol = protocol
         self.waiting_players = set()
+        self.deadline = None  # timer of the current question
 
         self.played_questions = 0
         self.jackpot = Jackpot()
         self.player_ids = [player.get_id() for player in players]
-        self.socket = socket
-        self.scoreboard = {}
-        self.item_table = ItemTable()
         for player_id in self.player_ids:
-            self.scoreboard[player_id] = 0
-        self.questions = self.quiz.get_random_questions()
+            ConnectionRegistry.join(self.group, player_id)
+        get_backplane().claim(self.group, self.player_ids)  # players on other nodes send their messages here
+        self.leaderboard = Leaderboard({player_id: 0 for player_id in self.player_ids})
+        self.scoreboard = self.leaderboard.scores  # {player_id: score}, changed through the leaderboard only
+        self.scoreboard_seq = 0  # number of scoreboard deltas sent so far
+        self.dirty_scores = set()  # players whose score changed since the last delta
+        self.item_table = ItemTable()
+        # only the ids are kept, the question objects are shared by all games through the QuestionPool
+        self.question_ids = [question.get_id() for question in self.quiz.get_random_questions(self.player_ids)]
 
     def get_id(self):
         return self.id
@@ -156,11 +214,36 @@ class Game:
         self.protocol.put(player_id, 'answered_question', question_id)
         self.check_for_next_question()
 
+    def accepts_answer(self, player_id, question_id):
+        """
+        False for late answers to a previous question, e.g. after its deadline, and for a second answer of a player
+        :param question_id: id of the answered question, also sent when the client's timer ran out
+        """
+        if player_id not in self.scoreboard or player_id in self.waiting_players:
+            return False
+        if not 0 < self.played_questions <= len(self.question_ids):  # not started or finished
+            return False
+        return question_id == self.question_ids[self.played_questions - 1]
+
     def check_for_next_question(self):
         if self.all_players_answered():
             self.waiting_players.clear()
             self.start_next_question()
 
+    def expire_question(self, question_index):
+        """
+        deadline of a question, the players that did not answer are resolved without points
+        """
+        if question_index != self.played_questions:
+            return
+        question_id = self.question_ids[question_index - 1]
+        unanswered = [player_id for player_id in self.player_ids if player_id not in self.waiting_players]
+        logger.debug('question %s of game %s expired, unanswered: %s', question_id, self.id, unanswered)
+        for player_id in unanswered:
+            self.waiting_players.add(player_id)
+            self.protocol.put(player_id, 'answered_question', question_id)
+        self.check_for_next_question()
+
     def get_played_questions_amount(self):
         return self.played_questions
 
@@ -168,8 +251,11 @@ class Game:
         return self.scoreboard
 
     def start(self):
-        msg = json.dumps({'type': 'game_start',
-                          'game_id': self.id})
+        self.state = RUNNING
+        msg = {'type': 'game_start',
+               'game_id': self.id,
+               'scoreboard': dict(self.scoreboard),
+               'seq': self.scoreboard_seq}
         self.notify_players(msg)
         for player_id in self.player_ids:
             self.protocol.put(player_id, 'joined_game', self.id)
@@ -179,80 +265,156 @@ class Game:
         self.start_next_question()
 
     def get_questions(self):
-        return self.questions
+        return [QuestionPool.get(question_id) for question_id in self.question_ids]
 
     def get_questions_json(self):
-        return [question.to_json() for question in self.questions]
+        return [question.to_json() for question in self.get_questions()]
 
     def get_jackpot(self):
         return self.jackpot
 
     def start_next_question(self):
+        self.cancel_deadline()
         end_flag = False
-        if self.played_questions == len(self.questions):
+        if self.played_questions == len(self.question_ids):
             self.end()
             end_flag = True
-        elif self.played_questions == (len(self.questions) - 1):
+        elif self.played_questions == (len(self.question_ids) - 1):
             self.jackpot.set_active(True)
         else:
             self.jackpot.random_activation()
 
         if not end_flag:
-            next_question = self.questions[self.played_questions].to_json()
+            next_question = QuestionPool.get(self.question_ids[self.played_questions]).to_json()
             # assign an item (fixed probability to happen) to a random wrong answer
             next_question = self.assign_item_eventually(next_question)
 
-            msg = json.dumps({'type': 'question',
-                              'question': next_question,
-                              'jackpot': {
-                                            'amount': self.jackpot.get_amount(),
-                                            'is_active': self.jackpot.get_is_active()},
-                              'scoreboard': self.scoreboard
-                              })
+            msg = {'type': 'question',
+                   'question': next_question,
+                   'jackpot': {
+                                'amount': self.jackpot.get_amount(),
+                                'is_active': self.jackpot.get_is_active()},
+                   'scoreboard_delta': self.take_scoreboard_delta()
+                   }
             self.notify_players(msg)
             for player_id in self.player_ids:
                 self.protocol.put(player_id, 'got_question', next_question['id'])
+            self.deadline = timers.schedule(next_question['responseTime'] + CONSTANTS.QUESTION_DEADLINE_GRACE,
+                                            self.expire_question, self.played_questions + 1)
         self.played_questions += 1
 
+    def cancel_deadline(self):
+        if self.deadline is not None:
+            self.deadline.cancel()
+            self.deadline = None
+
     def assign_item_eventually(self, next_question):
         chance = random.randint(1, 100)
         if chance <= CONSTANTS.ITEM_ASSIGNMENT_PROBABILITY:
             rand_index = random.randint(1, len(next_question['answers']) - 1)
-            next_question['answers'][rand_index]['assigned_effects'] = Item().get_effect(self.scoreboard)
+            next_question['answers'][rand_index]['assigned_effects'] = distributor.distribute(
+                self.leaderboard, self.item_table.get_player_items())
         return next_question
 
     def end(self):
+        self.state = FINISHED
+        self.cancel_deadline()
         self.save_end_results()
         self.send_end_results()
+        ConnectionRegistry.close_group(self.group)
+        GamePool.finish_game(self)
 
     def send_end_results(self):
-        msg = json.dumps({'type': 'scoreboard',
-                          'scoreboard': self.scoreboard})
+        msg = {'type': 'scoreboard',
+               'scoreboard_delta': self.take_scoreboard_delta()}
         self.notify_players(msg)
         for player_id in self.player_ids:
             self.protocol.put(player_id, 'got_scoreboard', True)
         self.log_protocol()
 
     def save_end_results(self):
-        # TODO
-        pass
+        """
+        the results are written on the io thread pool
+        :return: future of the write
+        """
+        future = run_io(store_game_result, self.quiz.get_id(), dict(self.scoreboard))
+        future.add_done_callback(log_failure)
+        return future
 
     def log_protocol(self):
         """
-        just for debugging
+        just for debugging, the file is written on the io thread pool
+        :return: future of the write
         """
-        with open("protocol.json", "w", encoding="utf-8") as f:
-            json.dump(self.protocol.table, f)
+        table = {player_id: dict(states) for player_id, states in self.protocol.table.items()}
+        future = run_io(write_protocol, table)
+        future.add_done_callback(log_failure)
+        return future
 
     def update_scoreboard(self, player_id, score):
         if player_id in self.scoreboard:
-            self.scoreboard[player_id] += score
+            self.leaderboard.add(player_id, score)
+            self.dirty_scores.add(player_id)
+
+    def get_leaders(self):
+        """
+        :return: [[player_id, score], ...] of the best LEADERBOARD_TOP players, best first
+        """
+        return [[player_id, score] for player_id, score in self.leaderboard.top(CONSTANTS.LEADERBOARD_TOP)]
+
+    def take_scoreboard_delta(self):
+        """
+        the scores that changed since the last delta. a client applies it if its scoreboard is at 'base',
+        otherwise it missed a delta and asks for the full scoreboard with a 'scoreboard_sync' message
+        :return: {'seq': sequence number after the delta, 'base': sequence number before, 'scores': {player_id: score},
+                  'leaders': see get_leaders}
+        """
+        delta = {'seq': self.scoreboard_seq + 1,
+                 'base': self.scoreboard_seq,
+                 'scores': {player_id: self.scoreboard[player_id] for player_id in self.dirty_scores},
+                 'leaders': self.get_leaders()}
+        self.scoreboard_seq += 1
+        self.dirty_scores.clear()
+        return delta
+
+    def send_scoreboard(self, player_id):
+        """
+        sends the full scoreboard to a single player, e.g. after they missed a delta
+        """
+        get_backplane().send(player_id, {'type': 'scoreboard_sync',
+                                         'scoreboard': dict(self.scoreboard),
+                                         'leaders': self.get_leaders(),
+                                         'seq': self.scoreboard_seq},
+                             key=('scoreboard', self.id))
+
+    def send_rank(self, player_id):
+        """
+        sends the rank of a player (1 for the leader) and the players around them
+        """
+        rank, around = self.leaderboard.around(player_id, CONSTANTS.LEADERBOARD_AROUND)
+        get_backplane().send(player_id, {'type': 'rank',
+                                         'rank': rank + 1,
+                                         'around': [[other_id, score] for other_id, score in around]},
+                             key=('rank', self.id))
 
     def all_players_answered(self):
         return len(self.waiting_players) == len(self.players)
 
     def notify_players(self, message):
-        self.socket.notify_clients(message)
+        get_backplane().broadcast(self.group, message)
+
+    def notify_players_except(self, player_id, message):
+        get_backplane().broadcast(self.group, message, player_id)
+
+
+def write_protocol(table):
+    with open("protocol.json", "wb") as f:
+        codec.dump(table, f)
+
+
+def log_failure(future):
+    if not future.cancelled() and future.exception() is not None:
+        logger.error('writing in the background failed', exc_info=future.exception())
 
 
 class Jackpot:
@@ -327,46 +489,6 @@ class Jackpot:
         self.amount += points
 
 
-class Item:
-    def __init__(self):
-        # dict with effect as key and initial impact value as value, all values tbd further
-        # further possibilites: freeze other players,
-        self.possible_effects = {
-            'scoreX2': 0.3,
-            'scoreX5': 0.7,
-            'score/2': 0.5,
-            'shuffle_question': 0.8,
-            'jackpot': 1,
-            'bomb': 0.6,
-            'move_answers': 0.7,
-            'hide_scoreboard': 0.1,
-            'get_points_save': 0.2
-        }
-        self.debug = ['move_answers']
-
-    def get_effect(self, scoreboard):
-        """
-        determines the items for every player
-        """
-        sorted_scoreboard = sorted(scoreboard.items(), key=lambda kv: kv[1], reverse=True)
-        effect_distribution = {}
-
-        for player in sorted_scoreboard:
-            # position relative = (position in scoreboard / number of players)
-            position_relative = (sorted_scoreboard.index(player)) / (len(sorted_scoreboard))
-            lower_bound = position_relative - CONSTANTS.RELATIVE_POSITION_DEVIATION
-            if lower_bound < 0:
-                lower_bound = 0
-            upper_bound = position_relative + CONSTANTS.RELATIVE_POSITION_DEVIATION
-            considered_items = {}
-            for item in self.possible_effects:
-                if self.possible_effects[item] >= lower_bound and self.possible_effects[item] <= upper_bound:
-                    considered_items[item] = item
-            if considered_items:
-                effect_distribution[player[0]] = random.choice(list(considered_items))  #player[0] because it is a tuple, we only need id though
-        return effect_distribution
-
-
 class ItemTable:
     def __init__(self):
         self.player_items = {}  # {item:{p_id1:quantity1,p_id2:quantity2,...},...}
@@ -385,15 +507,14 @@ class ItemTable:
                 self.player_items[item][p_id] += 1
 
     def check_and_activate_item(self, item, p_id):
-        if item not in self.player_items:
-            return False
-        else:
-            if p_id not in self.player_items[item]:
-                return False
-            else:
-                if self.player_items[item][p_id] > 0:
-                    self.player_items[item][p_id] -= 1
-                    return True
+        """
+        uses up one item of a player
+        :return: True if the player had the item
+        """
+        if self.player_items.get(item, {}).get(p_id, 0) > 0:
+            self.player_items[item][p_id] -= 1
+            return True
+        return False
 
     def clean(self):
         for element in self.player_items:
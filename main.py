@@ -1,10 +1,58 @@
 # -*- coding: utf-8 -*-
+import argparse
+import hmac
+import ipaddress
+import tornado.httpserver
 import tornado.ioloop
+import tornado.iostream
+import tornado.process
 import tornado.web
 import tornado.websocket
-import json
+import codec
+import CONSTANTS
 from logic import *
 from model import *
+from catalog import QuizCatalog
+from difficulty import answer_statistics, recalibrate
+from backplane import RemoteConnection, get_backplane, set_backplane, create_backplane
+from connections import ConnectionRegistry, Frame, game_group, lobby_group
+from session import SessionStore
+from router import MessageRouter, Schema, boolean, integer, number, string
+import wire
+import log
+from urllib.parse import urlparse
+from timerwheel import timers
+from workers import WorkerPool
+
+logger = log.get_logger('main')
+traffic_logger = log.get_traffic_logger('main')
+
+
+class JsonHandler(tornado.web.RequestHandler):
+    """
+    request handler that reads and writes json through the codec module
+    """
+    def get_json_body(self):
+        return codec.loads(self.request.body)
+
+    def write_json(self, data):
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.write(codec.dumps(data))
+
+
+class AdminHandler(JsonHandler):
+    """
+    handler of an administrative endpoint, it answers requests from the loopback interface, and requests from other
+    hosts that send ADMIN_SECRET in the X-Admin-Secret header
+    """
+    def prepare(self):
+        if ipaddress.ip_address(self.request.remote_ip).is_loopback:
+            return
+        secret = self.request.headers.get('X-Admin-Secret')
+        if CONSTANTS.ADMIN_SECRET is None or secret is None or \
+                not hmac.compare_digest(secret.encode('utf-8'), CONSTANTS.ADMIN_SECRET.encode('utf-8')):
+            logger.warning('rejected %s %s from %s', self.request.method, self.request.path, self.request.remote_ip)
+            raise tornado.web.HTTPError(403)
 
 
 class MainHandler(tornado.web.RequestHandler):
@@ -13,107 +61,321 @@ class MainHandler(tornado.web.RequestHandler):
 
 
 class QuizHandler(tornado.web.RequestHandler):
-    def get(self):
+    async def get(self):
         id = self.get_argument('id', None)
         if id is None:
-            quizzes = get_all_quizzes()
-            self.write(json.dumps([quiz.to_json() for quiz in quizzes]))
+            entry = await run_io(QuizCatalog.get_list)
         else:
-            quiz = get_quiz(id)
-            self.write(json.dumps(quiz.to_json()))
+            try:
+                id = int(id)
+            except ValueError:
+                raise tornado.web.HTTPError(400)
+            entry = await run_io(QuizCatalog.get_quiz, id)
+            if entry is None:
+                raise tornado.web.HTTPError(404)
+        body, etag = entry
+        self.set_header('Content-Type', 'application/json; charset=UTF-8')
+        self.set_header('Etag', etag)
+        if self.check_etag_header():  # client polls an unchanged catalog
+            self.set_status(304)
+        else:
+            self.write(body)
 
 
-class ItemQuantityHandler(tornado.web.RequestHandler):
-    def post(self):
-        data = json.loads(self.request.body.decode("utf-8"))
-        p_id = data['p_id']
-        game_id = data['game_id']
-        item = data['item']
-        bool_activate = GamePool.get_game(game_id).get_item_table().check_and_activate_item(item, p_id)
-        self.write(json.dumps({'activate': bool_activate}))
+class Recalibration:
+    """
+    recalibrates the dynamic difficulty of the questions on the io threads, one recalibration at a time
+    """
+    running = None  # future of the recalibration in flight
+
+    @staticmethod
+    def run():
+        """
+        :return: future of the number of changed questions, the running recalibration if there is one
+        """
+        if Recalibration.running is None or Recalibration.running.done():
+            Recalibration.running = run_io(recalibrate, answer_statistics)
+        return Recalibration.running
+
+    @staticmethod
+    def run_periodically():
+        """
+        callback of the PeriodicCallback, skipped while the previous recalibration is still in flight
+        """
+        if Recalibration.running is not None and not Recalibration.running.done():
+            logger.warning('recalibration is still running, skipped')
+            return
+        Recalibration.run().add_done_callback(Recalibration._log_failure)
+
+    @staticmethod
+    def _log_failure(future):
+        if not future.cancelled() and future.exception() is not None:
+            logger.error('recalibration failed', exc_info=future.exception())
+
 
+class RecalibrationHandler(AdminHandler):
+    async def post(self):
+        """
+        recalibrates the dynamic difficulty of the questions on demand
+        """
+        self.write_json({'changed': await Recalibration.run()})
+
+
+class StatsHandler(AdminHandler):
+    def get(self):
+        """
+        send queue depth per connected player and the amount of games per state
+        """
+        self.write_json({'connections': ConnectionRegistry.get_stats(), 'games': GamePool.get_stats()})
+
+
+class LogLevelHandler(AdminHandler):
+    def get(self):
+        self.write_json({'levels': log.get_levels(), 'dropped': log.get_dropped()})
 
-class LoginHandler(tornado.web.RequestHandler):
     def post(self):
-        data = json.loads(self.request.body.decode("utf-8"))
+        """
+        changes the log level at runtime, e.g. POST /loglevel?level=DEBUG&module=main.traffic
+        """
+        if not log.set_level(self.get_argument('level').upper(), self.get_argument('module', None)):
+            raise tornado.web.HTTPError(400)
+        self.write_json({'levels': log.get_levels()})
+
+
+class RouteHandler(JsonHandler):
+    async def get(self):
+        """
+        websocket port of the worker that hosts the next lobby of a quiz, e.g. GET /route?q_id=1
+        """
+        try:
+            quiz_id = int(self.get_argument('q_id'))
+        except ValueError:
+            raise tornado.web.HTTPError(400)
+        quiz = await get_quiz_async(quiz_id)
+        if quiz is None:
+            raise tornado.web.HTTPError(404)
+        worker = WorkerPool.route(quiz_id, quiz.get_min_participants())
+        self.write_json({'worker': worker, 'port': WorkerPool.get_port(worker)})
+
+
+class LoginHandler(JsonHandler):
+    async def post(self):
+        data = self.get_json_body()
         username = data['username']
-        player_id = get_player_id(username)
+        player_id = await get_player_id_async(username)
         if player_id:
-            self.write({'p_id': player_id})
+            player = await get_player_async(player_id)
+            self.write_json({'p_id': player_id, 'token': SessionStore.create(player)})
         else:
-            self.write({'p_id': -1})
+            self.write_json({'p_id': -1})
+
+
+def forward_game_message(connection, game_id, message):
+    """
+    messages for a game of another node go to that node
+    """
+    return get_backplane().forward(game_group(game_id), connection, message)
+
+
+router = MessageRouter(GamePool.get_player_game, forward_game_message)
+
+
+def handle_forwarded_message(player_id, nickname, message):
+    """
+    message of a player of another node for a lobby or game of this node
+    """
+    return router.dispatch_message(RemoteConnection(Player(nickname=nickname, pid=player_id)), message)
+
+
+played_question = Schema('PlayedQuestion', {'score': number,
+                                            'is_correct': boolean,
+                                            'is_jackpot': (boolean, False),
+                                            'acquired_item': (string, None)})
+
+
+@router.route('user_message', message=string)
+def user_message(context, message):
+    for group in ConnectionRegistry.get_groups(context.player_id):  # the lobby or game of the player
+        get_backplane().broadcast(group, {'type': 'user_message', 'message': message.message})
+
+
+@router.route('join_lobby', q_id=integer)
+async def join_lobby(context, message):
+    if message.q_id not in LobbyPool.lobbies and \
+            get_backplane().forward(lobby_group(message.q_id), context.connection,
+                                    dict(message._asdict(), type='join_lobby'), claim=True):
+        return
+    quiz = None
+    if message.q_id not in LobbyPool.lobbies:
+        quiz = await get_quiz_async(message.q_id)
+        if quiz is None:
+            logger.warning('rejected join of player %s to the lobby of unknown quiz %s', context.player_id,
+                           message.q_id)
+            return
+    LobbyPool.join_lobby(context.player, message.q_id, quiz)
+
+
+@router.route('leave_lobby', q_id=(integer, 1))
+def leave_lobby(context, message):
+    if message.q_id not in LobbyPool.lobbies and \
+            get_backplane().forward(lobby_group(message.q_id), context.connection,
+                                    dict(message._asdict(), type='leave_lobby')):
+        return
+    if message.q_id not in LobbyPool.lobbies:
+        logger.warning('rejected leave of player %s from the lobby of quiz %s, there is none', context.player_id,
+                       message.q_id)
+        return
+    LobbyPool.leave_lobby(context.player, message.q_id)
+
+
+@router.route('answered_question', game_id=integer, q_id=integer, played_question=played_question)
+def answered_question(context, message):
+    game = context.game
+    if not game.accepts_answer(context.player_id, message.q_id):
+        traffic_logger.info('ignored answer of player %s to question %s', context.player_id, message.q_id)
+        return
+    played = message.played_question
+    answer_statistics.record(message.q_id, played.is_correct)
+    game.update_scoreboard(context.player_id, played.score)
+    game.add_waiting_player(context.player_id, message.q_id)
+    if not played.is_correct:
+        game.get_jackpot().increase_payout_chance(1)
+        game.get_jackpot().add_points(200)  # TODO make this generic to questions worth, need to send this with the msg
+    elif played.is_jackpot:
+        game.get_jackpot().payed_out()
+    # TODO when PlayedQuestion Model exists: generate pq, add pq tp game
+    if played.acquired_item is not None:
+        game.get_item_table().add_item(played.acquired_item, context.player_id)
+        logger.debug('items of game %s: %s', game.get_id(), game.get_item_table().get_player_items())
+
+
+@router.route('item_activation', game_id=integer, item=string, target=(integer, None), req_id=(integer, None))
+def item_activation(context, message):
+    """
+    uses up the item and broadcasts its effect, the player gets an 'item_ack' with the req_id of the activation.
+    an effect aimed at a player must target another player of the game, otherwise the item is kept
+    """
+    if message.target is not None and (message.target == context.player_id
+                                       or message.target not in context.game.get_scoreboard()):
+        activated = False
+    else:
+        activated = context.game.get_item_table().check_and_activate_item(message.item, context.player_id)
+    logger.debug('player %s triggered item %s, activated: %s', context.player_id, message.item, activated)
+    get_backplane().send(context.player_id, {'type': 'item_ack',
+                                             'req_id': message.req_id,
+                                             'item': message.item,
+                                             'activate': activated})
+    if not activated or message.item in CONSTANTS.SELF_ITEMS:
+        return
+    activation = {'type': 'item_activation',
+                  'item': message.item}
+    if message.target is not None:  # effect aimed at a single player
+        get_backplane().send(message.target, activation)
+    elif message.item == 'jackpot':
+        context.game.notify_players(activation)
+    else:
+        context.game.notify_players_except(context.player_id, activation)
+
+
+@router.route('rank', game_id=integer)
+def rank(context, message):
+    if context.player_id in context.game.get_scoreboard():
+        context.game.send_rank(context.player_id)
+
+
+@router.route('scoreboard_sync', game_id=integer)
+def scoreboard_sync(context, message):
+    """
+    the client missed a scoreboard delta
+    """
+    if context.player_id in context.game.get_scoreboard():
+        context.game.send_scoreboard(context.player_id)
 
 
 class SimpleWebSocket(tornado.websocket.WebSocketHandler):
     pid = ''
-    connections = set()
+    player = None
+    encoding = wire.JSON
 
-    def open(self, p_id):
-        self.pid = int(p_id)
-        self.connections.add(self)
+    def check_origin(self, origin):
+        """
+        the page is served from the main port, websockets of workers are on other ports of the same host
+        """
+        return urlparse(origin).hostname == self.request.host_name
 
-    def on_message(self, message):
-        msg = json.loads(message)
-        print("incoming message: " + message)
-        if 'type' in msg:  # 'type' always needs to be in an incoming message
-            if msg['type'] == 'user_message':
-                self.notify_clients(json.dumps(msg))
-            elif msg['type'] == 'join_lobby':
-                player_id = msg['p_id']
-                quiz_id = msg['q_id']
-                player = get_player(player_id)
-                # TODO when quiz model implemented: quiz_id needs to be supplied
-                LobbyPool.join_lobby(player, self, quiz_id)  # TODO when quiz model implemented: quiz_id as 3rd parameter
-            elif msg['type'] == 'leave_lobby':
-                player_id = msg['p_id']
-                player = get_player(player_id)
-                LobbyPool.leave_lobby(player)
-            elif msg['type'] == 'answered_question':
-                if all(key in msg for key in ('game_id', 'q_id', 'played_question')):  # we now also need game_id, q_id and played_question for answer signal
-                    player_id = msg['p_id']
-                    game_id = msg['game_id']
-                    question_id = msg['q_id']
-                    GamePool.get_game(game_id).update_scoreboard(player_id, msg['played_question']['score'])
-                    GamePool.get_game(game_id).add_waiting_player(player_id, question_id)
-                    if msg['played_question']['is_correct'] == False:
-                        GamePool.get_game(game_id).get_jackpot().increase_payout_chance(1)
-                        GamePool.get_game(game_id).get_jackpot().add_points(200)  # TODO make this generic to questions worth, need to send this with the msg
-                    if msg['played_question']['is_correct'] == True and msg['played_question']['is_jackpot'] == True:
-                        GamePool.get_game(game_id).get_jackpot().payed_out()
-                    # TODO when PlayedQuestion Model exists: check if keys for pq exists, generate pq, add pq tp game
-                    if 'acquired_item' in msg['played_question']:
-                        item = msg['played_question']['acquired_item']
-                        GamePool.get_game(game_id).get_item_table().add_item(item, player_id)
-                        print(GamePool.get_game(game_id).get_item_table().get_player_items())
-            elif msg['type'] == 'item_activation':
-                p_id = msg['p_id']
-                item = msg['item']
-                game_id = msg['game_id']
-                print("Player " + str(p_id) + " triggered Item: " + item)
-                message = json.dumps({'type': 'item_activation',
-                                      'item': item})
-                if item == 'jackpot':
-                    self.notify_clients(message)
-                else:
-                    self.notify_clients_except_self(p_id, message)
-            else:
-                print('Could not resolve "type" key: ' + msg['type'])
+    def get_compression_options(self):
+        if CONSTANTS.WEBSOCKET_COMPRESSION:
+            return {'compression_level': CONSTANTS.WEBSOCKET_COMPRESSION_LEVEL}
+        return None
 
-        else:
-            print('Message Error, key "type"')
+    def get_shared_deflate_bits(self):
+        """
+        window bits of frames deflated for all recipients that can be sent to this client, None if it cannot take
+        them. that needs permessage-deflate without server context takeover, otherwise the client's window would not
+        match tornado's own compressor, and the server_max_window_bits the client negotiated.
+        relies on tornado's compressor internals, anything unexpected means plain frames
+        """
+        compressor = getattr(self.ws_connection, '_compressor', None)
+        if compressor is None or getattr(compressor, '_compressor', True) is not None:
+            return None
+        return getattr(compressor, '_max_wbits', None)
+
+    def select_subprotocol(self, subprotocols):
+        """
+        picks the wire encoding of server messages, clients that offer none get json
+        """
+        for subprotocol in wire.SUBPROTOCOLS:
+            if subprotocol in subprotocols:
+                return subprotocol
+        return None
 
-    def notify_clients(self, message):
-        for client in self.connections:
-            client.write_message(message)
+    def encode_frame(self, frame):
+        """
+        :param frame: connections.Frame, encoded once for all recipients with the same encoding
+        """
+        return frame.get_bytes(self.encoding, self.get_shared_deflate_bits())
 
-    def notify_clients_except_self(self, p_id, message):
-        for client in self.connections:
-            if client.pid != p_id:
-                client.write_message(message)
+    def write_bytes(self, data):
+        """
+        writes encoded frames to the socket
+        :return: future that resolves when the data was handed to the socket, None if the connection is closed
+        """
+        if self.ws_connection is None or self.ws_connection.is_closing():
+            return None
+        try:
+            return self.ws_connection.stream.write(data)
+        except tornado.iostream.StreamClosedError:
+            return None
+
+    async def open(self):
+        """
+        the player is resolved once from the session token of the login, e.g. /websocket?token=...
+        """
+        self.player = await SessionStore.resolve(self.get_argument('token', ''))
+        if self.player is None:
+            logger.info('rejected websocket with an invalid session token')
+            self.close(4001, 'invalid session')
+            return
+        self.pid = self.player.get_id()
+        self.encoding = self.selected_subprotocol or wire.JSON
+        ConnectionRegistry.register(self.pid, self)
+        get_backplane().subscribe(self.pid)
+        if self.encoding == wire.MSGPACK:
+            # pairs instead of a dict, so the tags themselves are not compacted
+            ConnectionRegistry.queue(self.pid, Frame({'type': 'wire_tags', 'tags': list(wire.TAGS.items())}))
+
+    def on_message(self, message):
+        traffic_logger.debug('incoming message: %s', message)
+        # a coroutine handler is awaited by tornado before the next message of this connection is processed
+        return router.dispatch(self, message)
 
     def on_close(self):
-        self.connections.remove(self)
-        print('connection to client ' + str(self.pid) + " closed by client")
+        if self.player is None:
+            return  # rejected in open
+        ConnectionRegistry.unregister(self.pid, self)
+        if ConnectionRegistry.get_connection(self.pid) is None:  # unless the player reconnected in the meantime
+            get_backplane().unsubscribe(self.pid)
+        logger.debug('connection to client %s closed by client', self.pid)
 
 
 def make_app():
@@ -121,15 +383,38 @@ def make_app():
         (r"/", MainHandler),
         (r"/quizzes", QuizHandler),
         (r"/login", LoginHandler),
-        (r"/checkItemQuantity", ItemQuantityHandler),
+        (r"/recalibrate", RecalibrationHandler),
+        (r"/stats", StatsHandler),
+        (r"/route", RouteHandler),
+        (r"/loglevel", LogLevelHandler),
         (r"/websocket", SimpleWebSocket),
         (r"/css/(.*)", tornado.web.StaticFileHandler, {"path": "./css/"},),
-        (r"/img/(.*)", tornado.web.StaticFileHandler, {"path": "./img/"},),
-        (r"/websocket/p_id/(.*)", SimpleWebSocket)
+        (r"/img/(.*)", tornado.web.StaticFileHandler, {"path": "./img/"},)
     ])
 
 
 if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='quiz game server')
+    parser.add_argument('--port', type=int, default=CONSTANTS.PORT)
+    parser.add_argument('--workers', type=int, default=CONSTANTS.WORKERS, help='server processes, 0 for one per cpu core')
+    parser.add_argument('--storage', default=CONSTANTS.STORAGE_BACKEND, choices=('json', 'jsonl', 'sqlite'),
+                        help='storage backend, several workers need sqlite')
+    args = parser.parse_args()
+    if (args.workers or tornado.process.cpu_count()) > 1 and args.storage != 'sqlite':
+        # the json files are copied into every worker, each would allocate the same ids and overwrite the others
+        parser.error('several workers need the sqlite storage backend, run storage.py migrate and pass --storage sqlite')
+    CONSTANTS.PORT = args.port
+    CONSTANTS.STORAGE_BACKEND = args.storage
+    sockets = WorkerPool.start(args.workers, args.port)  # forks, everything below runs in every worker
+    log.setup()
+    set_backplane(create_backplane())
+    get_backplane().handler = handle_forwarded_message
     app = make_app()
-    app.listen(8888)
+    server = tornado.httpserver.HTTPServer(app)
+    server.add_sockets(sockets)
+    if WorkerPool.count > 1:
+        app.listen(WorkerPool.get_port(WorkerPool.index))
+        logger.info('worker %d listening on port %d', WorkerPool.index, WorkerPool.get_port(WorkerPool.index))
+    timers.start()
+    tornado.ioloop.PeriodicCallback(Recalibration.run_periodically, CONSTANTS.RECALIBRATION_INTERVAL * 1000).start()
     tornado.ioloop.IOLoop.current().start()
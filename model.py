@@ -1,19 +1,66 @@
 # -*- coding: utf-8 -*-
-import json
+import asyncio
+import functools
+import sys
+import time
+from concurrent.futures import ThreadPoolExecutor
+import CONSTANTS
+from storage import get_storage
+from selection import selector
+from log import get_logger
 
+logger = get_logger('model')
 
-class Answer:
-    def __init__(self, content=None, type=False):
-        self.content = content
-        self.type = type
-        self.aid = None
+# storage access of request handlers runs here, so file reads do not block the event loop
+io_executor = ThreadPoolExecutor(CONSTANTS.IO_THREADS, thread_name_prefix='io')
+
+
+class Record:
+    """
+    base of the read-only model objects, they are shared by every game through the pools and caches.
+    the fields are set once by the constructor, with_id() returns a copy that has an id
+    """
+    __slots__ = ()
+    id_field = None  # slot of the id
+
+    def __init__(self, **fields):
+        for name, value in fields.items():
+            object.__setattr__(self, name, value)
+
+    def __setattr__(self, name, value):
+        raise AttributeError(type(self).__name__ + ' is read-only')
+
+    def __delattr__(self, name):
+        raise AttributeError(type(self).__name__ + ' is read-only')
+
+    def with_id(self, id):
+        """
+        :return: copy of the object with the id assigned by the storage
+        """
+        copy = object.__new__(type(self))
+        for name in type(self).__slots__:
+            object.__setattr__(copy, name, getattr(self, name))
+        object.__setattr__(copy, self.id_field, id)
+        return copy
+
+
+class Answer(Record):
+    """
+    answers are shared by every game through the QuestionPool
+    """
+    __slots__ = ('content', 'type', 'aid')
+    id_field = 'aid'
+
+    def __init__(self, content=None, type=False, aid=None):
+        Record.__init__(self, content=content, type=type, aid=aid)
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(sys.intern(data['content']), data['type'], data['id'])
 
     def get_id(self):
         return self.aid
 
-    def set_id(self, aid):
-        self.aid = aid
-
     def get_content(self):
         return self.content
 
@@ -24,27 +71,46 @@ class Answer:
         return 'ID: ' + str(self.aid) + ' Content: ' + self.content + ' Type: ' + str(self.type)
 
 
-class Question:
-    def __init__(self, questioning=None, topic=None, answers=None, dynamic_difficulty=None, static_difficulty=None, response_time=None, worth=None):
-        self.questioning = questioning
-        self.topic = topic
-        self.answers = answers
-        self.dynamic_difficulty = dynamic_difficulty
-        self.static_difficulty = static_difficulty
-        self.response_time = response_time
-        self.worth = worth
-        self.qid = get_question_id(questioning)
-        if self.qid is None:
-            store_question(self)
-            self.qid = get_question_id(questioning)
+class Question(Record):
+    """
+    one instance per question id is shared by every game through the QuestionPool
+    """
+    __slots__ = ('questioning', 'topic', 'answers', 'dynamic_difficulty', 'static_difficulty', 'response_time', 'worth', 'qid')
+    id_field = 'qid'
+
+    def __init__(self, questioning=None, topic=None, answers=None, dynamic_difficulty=None, static_difficulty=None, response_time=None, worth=None, qid=None):
+        """
+        plain constructor without storage access, use create() for new questions and from_json() for stored ones
+        """
+        Record.__init__(self, questioning=questioning, topic=topic, answers=tuple(answers) if answers is not None else None,
+                        dynamic_difficulty=dynamic_difficulty, static_difficulty=static_difficulty,
+                        response_time=response_time, worth=worth, qid=qid)
+
+    @classmethod
+    def create(cls, questioning, topic, answers, dynamic_difficulty, static_difficulty, response_time, worth):
+        """
+        creates a new question and stores it. if a question with the same questioning is stored already, that one is returned
+        """
+        qid = get_question_id(questioning)
+        if qid is not None:
+            return get_question(qid)
+        answers = tuple(answers)
+        qid = store_question(question_record(questioning, topic, answers, dynamic_difficulty, static_difficulty,
+                                             response_time, worth))
+        return cls(questioning, topic, answers, dynamic_difficulty, static_difficulty, response_time, worth, qid)
+
+    @classmethod
+    def from_json(cls, data):
+        """
+        rehydrates a stored question from its json record
+        """
+        return cls(data['questioning'], sys.intern(data['topic']), [Answer.from_json(answer) for answer in data['answers']],
+                   data['dynamicDifficulty'], data['staticDifficulty'], data['responseTime'], data['worth'], data['id'])
 
 
     def get_id(self):
         return self.qid
 
-    def set_id(self, qid):
-        self.qid = qid
-
     def get_questioning(self):
         return self.questioning
 
@@ -66,12 +132,6 @@ class Question:
     def get_worth(self):
         return self.worth
 
-    def get_quiz(self):
-        return self.quiz
-
-    def set_quiz(self, quiz):
-        self.quiz = quiz
-
     def __eq__(self, other):
         if isinstance(other, self.__class__):
             return self.qid == other.get_id()
@@ -84,31 +144,8 @@ class Question:
         """
         converts question obj to dict, but does not yet dump it to json string because socket dumps it later itself
         """
-        return {'answers': [
-                            {'id': 1,
-                             'content': self.get_answers()[0].get_content(),
-                             'type': self.get_answers()[0].get_type()
-                            },
-                            {'id': 2,
-                             'content': self.get_answers()[1].get_content(),
-                             'type': self.get_answers()[1].get_type()
-                            },
-                            {'id': 3,
-                             'content': self.get_answers()[2].get_content(),
-                             'type': self.get_answers()[2].get_type()
-                            },
-                            {'id': 4,
-                             'content': self.get_answers()[3].get_content(),
-                             'type': self.get_answers()[3].get_type()
-                            },
-                          ],
-                        'dynamicDifficulty': self.get_dynamic_difficulty(),
-                        'staticDifficulty': self.get_static_difficulty(),
-                        'id': self.get_id(),
-                        'questioning': self.get_questioning(),
-                        'responseTime': self.get_response_time(),
-                        'topic': self.get_topic(),
-                        'worth': self.get_worth()}
+        return question_record(self.questioning, self.topic, self.answers, self.dynamic_difficulty,
+                               self.static_difficulty, self.response_time, self.worth, self.qid)
 
     def __str__(self):
         return 'ID: ' + str(self.qid) + ' Questioning: ' + self.questioning + \
@@ -117,26 +154,33 @@ class Question:
                ' Response Time: ' + str(self.response_time) + ' Worth: ' + str(self.worth)
 
 
-class Player:
-    def __init__(self, mail=None, nickname=None, password=None):
-        self.mail = mail
-        self.nickname = nickname
-        self.password = password
-        self.pid = get_player_id(nickname)
-        if self.pid is None:
-            store_player(self)
-            self.pid = get_player_id(nickname)
+class Player(Record):
+    __slots__ = ('mail', 'nickname', 'password', 'pid')
+    id_field = 'pid'
 
-    def get_id(self):
-        return self.pid
+    def __init__(self, mail=None, nickname=None, password=None, pid=None):
+        """
+        plain constructor without storage access, use create() for new players and from_json() for stored ones
+        """
+        Record.__init__(self, mail=mail, nickname=nickname, password=password, pid=pid)
 
-    def set_id(self, pid):
+    @classmethod
+    def create(cls, mail, nickname, password):
         """
-        do not call manually to avoid storage conflicts because ids are system generated
-        :param pid:
-        :return:
+        registers a new player. if the nickname is taken already, the stored player is returned
         """
-        self.pid = pid
+        pid = get_player_id(nickname)
+        if pid is not None:
+            return get_player(pid)
+        instance = cls(mail, nickname, password)
+        return instance.with_id(store_player(instance))
+
+    @classmethod
+    def from_json(cls, data):
+        return cls(data['mail'], data['nickname'], data['password'], data['id'])
+
+    def get_id(self):
+        return self.pid
 
     def get_nickname(self):
         return self.nickname
@@ -159,29 +203,45 @@ class Player:
         return self.pid != other.get_id()
 
 
-class Quiz:
-    def __init__(self, title=None, length=None, min_participants=None):
-        self.title = title
-        self.length = length
-        self.min_participants = min_participants
-        self.id = get_quiz_id(title)
-        if self.id is None:
-            store_quiz(self)
-            self.id = get_quiz_id(title)
-        self.questions = get_questions_of_quiz(self)
+class Quiz(Record):
+    __slots__ = ('title', 'length', 'min_participants', 'id', 'questions')
+    id_field = 'id'
+
+    def __init__(self, title=None, length=None, min_participants=None, id=None, questions=None):
+        """
+        plain constructor without storage access, use create() for new quizzes and from_json() for stored ones
+        :param questions: questions of the quiz, kept as a tuple. if None, they are looked up on every access
+        """
+        Record.__init__(self, title=title, length=length, min_participants=min_participants, id=id,
+                        questions=None if questions is None else tuple(questions))
+
+    @classmethod
+    def create(cls, title, length, min_participants):
+        """
+        creates a new quiz and stores it. if a quiz with the same title is stored already, that one is returned
+        """
+        id = get_quiz_id(title)
+        if id is not None:
+            return get_quiz(id)
+        instance = cls(title, length, min_participants)
+        return instance.with_id(store_quiz(instance))
+
+    @classmethod
+    def from_json(cls, data, questions=None):
+        return cls(data['title'], data['length'], data['min_participants'], data['id'], questions)
 
-    def get_random_questions(self):
-        # for now just use the first |length| questions
-        # TODO implement randomly choosing algorithm with consideration of preffering often wrongly answered Questions
-        # (needs data from saved games to work though)
-        return [self.questions[i] for i in range(self.length + 1)]
+    def get_random_questions(self, player_ids=(), question_selector=None):
+        """
+        weighted random choice of |length| + 1 questions, questions the players got recently are avoided
+        :param player_ids: players of the game
+        :param question_selector: defaults to the process wide selector
+        """
+        ids = (question_selector or selector).select(self.title, self.length + 1, player_ids)
+        return [QuestionPool.get(question_id) for question_id in ids]
 
     def get_id(self):
         return self.id
 
-    def set_id(self, id):
-        self.id = id
-
     def get_title(self):
         return self.title
 
@@ -192,11 +252,12 @@ class Quiz:
         return self.min_participants
 
     def get_questions(self):
-        return self.questions
-
-    def add_question(self, question):
-        if question not in self.questions:
-            self.questions.append(question)
+        """
+        :return: tuple of the questions of the quiz, shared through the QuestionPool
+        """
+        if self.questions is not None:
+            return self.questions
+        return get_questions_of_quiz(self)
 
     def to_json(self):
         return {'title': self.title,
@@ -205,183 +266,199 @@ class Quiz:
                 'id': self.id}
 
 
-def get_player(id, json_path="players.json"):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        if int(id) > int(data['highest_id']):
-            print('player will be none because id too high')
-            return None
-        else:
-            for player in data['players']:
-                if player['id'] == int(id):
-                    instance = Player(player['mail'], player['nickname'], player['password'])
-                    instance.set_id(player['id'])
-                    return instance
-            print('player will be none because not found')
-            return None
-
-
-def get_question(id, json_path='questions.json'):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        if int(id) > int(data['highest_id']):
-            return None
-        else:
-            for question in data['questions']:
-                if question['id'] == id:
-                    answers = []
-                    for answer in question['answers']:
-                        answer_instance = Answer(answer['content'], answer['type'])
-                        answer_instance.set_id(answer['id'])
-                        answers.append(answer_instance)
-                    instance = Question(question['questioning'], question['topic'], answers,
-                                        question['dynamicDifficulty'], question['staticDifficulty'],
-                                        question['responseTime'], question['worth'])
-                    instance.set_id(question['id'])
-                    return instance
-            return None
-
-
-def get_questions_of_quiz(quiz, json_path='questions.json'):
-    question_list = []
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        for question in data['questions']:
-            if question['topic'] == quiz.get_title():
-                answers = []
-                for answer in question['answers']:
-                    answer_instance = Answer(answer['content'], answer['type'])
-                    answer_instance.set_id(answer['id'])
-                    answers.append(answer_instance)
-                instance = Question(question['questioning'], question['topic'], answers,
-                                    question['dynamicDifficulty'], question['staticDifficulty'],
-                                    question['responseTime'], question['worth'])
-                instance.set_id(question['id'])
-                question_list.append(instance)
-    return question_list
-
-
-def get_quiz(id, json_path='quizzes.json'):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        if int(id) > int(data['highest_id']):
-            return None
-        else:
-            for quiz in data['quizzes']:
-                if quiz['id'] == int(id):
-                    instance = Quiz(quiz['title'], quiz['length'], quiz['min_participants'])
-                    instance.set_id(quiz['id'])
-                    return instance
-            return None
-
-def get_all_quizzes(json_path='quizzes.json'):
-    quizzes = []
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        for quiz in data['quizzes']:
-            instance = Quiz(quiz['title'], quiz['length'], quiz['min_participants'])
-            instance.set_id(quiz['id'])
-            quizzes.append(instance)
-        return quizzes
-
-def store_player(player, json_path='players.json'):
+class QuestionPool:
+    """
+    process wide pool of question objects, one per question id.
+    games keep the ids of their questions and resolve them here instead of holding private copies.
+    the pool is dropped when the stored questions change
+    """
+    questions = {}  # {question_id: question}
+    version = None  # storage version the pooled questions were built from
+
+    @staticmethod
+    def get(qid):
+        """
+        :return: the shared question or None if there is no such question
+        """
+        QuestionPool._check_version()
+        qid = int(qid)
+        question = QuestionPool.questions.get(qid)
+        if question is None:
+            record = get_storage().get_record('questions', qid)
+            if record is None:
+                return None
+            question = QuestionPool.questions[qid] = Question.from_json(record)
+        return question
+
+    @staticmethod
+    def get_from_record(record):
+        """
+        get the shared question of a record taken from the storage
+        """
+        QuestionPool._check_version()
+        question = QuestionPool.questions.get(record['id'])
+        if question is None:
+            question = QuestionPool.questions[record['id']] = Question.from_json(record)
+        return question
+
+    @staticmethod
+    def _check_version():
+        version = get_storage().get_version('questions')
+        if version != QuestionPool.version:
+            QuestionPool.questions = {}
+            QuestionPool.version = version
+
+
+def get_player(id, storage=None):
+    player = (storage or get_storage()).get_record('players', id)
+    if player is None:
+        logger.debug('player %s not found', id)
+        return None
+    return Player.from_json(player)
+
+
+def get_question(id):
+    return QuestionPool.get(id)
+
+
+def get_questions_of_quiz(quiz, storage=None):
+    records = (storage or get_storage()).find_records('questions', 'topic', quiz.get_title())
+    if storage is not None:
+        return tuple(Question.from_json(record) for record in records)
+    return tuple(QuestionPool.get_from_record(record) for record in records)
+
+
+def get_quiz(id, storage=None):
+    quiz = (storage or get_storage()).get_record('quizzes', id)
+    if quiz is None:
+        return None
+    return Quiz.from_json(quiz)
+
+
+def get_all_quizzes(storage=None):
+    storage = storage or get_storage()
+    return hydrate_quizzes(storage.all_records('quizzes'), storage.all_records('questions'))
+
+
+def hydrate_quizzes(quiz_records, question_records):
+    """
+    builds all quizzes including their questions from already parsed records in a single pass,
+    without any per object lookups or writes. the questions are the shared ones of the QuestionPool
+    :param quiz_records: list of quiz dicts as stored in quizzes.json
+    :param question_records: list of question dicts as stored in questions.json
+    :return: list of Quiz objects
+    """
+    questions_by_topic = {}
+    for record in question_records:
+        questions_by_topic.setdefault(record['topic'], []).append(QuestionPool.get_from_record(record))
+    return [Quiz.from_json(record, questions_by_topic.get(record['title'], ())) for record in quiz_records]
+
+
+def store_player(player, storage=None):
     '''
-    stores/adds player to json file, increments highest_id field
+    stores/adds player to the storage, the id is allocated by the storage
     :param player: player to add
-    :param json_path: path to json file
-    :return: void
+    :param storage: storage backend, defaults to the configured one
+    :return: the new id
+    '''
+    new_id = (storage or get_storage()).insert('players', {'id': None,
+                                                           'nickname': player.get_nickname(),
+                                                           'password': player.get_password(),
+                                                           'mail': player.get_mail()})
+    logger.info('stored player %d', new_id)
+    return new_id
+
+
+def question_record(questioning, topic, answers, dynamic_difficulty, static_difficulty, response_time, worth, qid=None):
+    """
+    :return: the stored json record of a question
+    """
+    return {'answers': [{'id': index, 'content': answer.get_content(), 'type': answer.get_type()}
+                        for index, answer in enumerate(answers[:4], 1)],
+            'dynamicDifficulty': dynamic_difficulty,
+            'staticDifficulty': static_difficulty,
+            'id': qid,
+            'questioning': questioning,
+            'responseTime': response_time,
+            'topic': topic,
+            'worth': worth}
+
+
+def store_question(record, storage=None):
+    """
+    :param record: json record of the question, see question_record()
+    :return: the new id
+    """
+    new_id = (storage or get_storage()).insert('questions', record)
+    logger.info('stored question %d', new_id)
+    return new_id
+
+
+def store_quiz(quiz, storage=None):
+    new_id = (storage or get_storage()).insert('quizzes', {'id': None,
+                                                           'title': quiz.get_title(),
+                                                           'length': quiz.get_length(),
+                                                           'min_participants': quiz.get_min_participants()
+                                                           })
+    logger.info('stored quiz %d', new_id)
+    return new_id
+
+
+def store_game_result(quiz_id, scoreboard, storage=None):
+    '''
+    stores the final scores of a game
+    :param scoreboard: {player_id: score}
+    :return: the new id
     '''
-    with open(json_path, 'r', encoding='utf-8') as f:
-        data = json.load(f)
-        new_id = data['highest_id'] + 1
-        data['players'].append({'id': new_id,
-                                'nickname': player.get_nickname(),
-                                'password': player.get_password(),
-                                'mail': player.get_mail()})
-        data['highest_id'] = new_id
-    with open(json_path, 'w', encoding='utf-8') as f:
-        print('stored player ID: ' + str(new_id) + ' to data')
-        json.dump(data, f)
-
-
-def store_question(question, json_path='questions.json'):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        new_id = data['highest_id'] + 1
-        data['questions'].append({'answers': [
-                                                {'id': 1,
-                                                 'content': question.get_answers()[0].get_content(),
-                                                 'type': question.get_answers()[0].get_type()
-                                                },
-                                                {'id': 2,
-                                                 'content': question.get_answers()[1].get_content(),
-                                                 'type': question.get_answers()[1].get_type()
-                                                },
-                                                {'id': 3,
-                                                 'content': question.get_answers()[2].get_content(),
-                                                 'type': question.get_answers()[2].get_type()
-                                                },
-                                                {'id': 4,
-                                                 'content': question.get_answers()[3].get_content(),
-                                                 'type': question.get_answers()[3].get_type()
-                                                },
-                                             ],
-                                  'dynamicDifficulty': question.get_dynamic_difficulty(),
-                                  'staticDifficulty': question.get_static_difficulty(),
-                                  'id': new_id,
-                                  'questioning': question.get_questioning(),
-                                  'responseTime': question.get_response_time(),
-                                  'topic': question.get_topic(),
-                                  'worth': question.get_worth()})
-        data['highest_id'] = new_id
-    with open(json_path, 'w', encoding='utf-8') as f:
-        print('stored Question ID: ' + str(new_id) + ' to data')
-        json.dump(data, f)
-
-
-def store_quiz(quiz, json_path='quizzes.json'):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        new_id = data['highest_id'] + 1
-        data['quizzes'].append({'id': new_id,
-                                'title': quiz.get_title(),
-                                'length': quiz.get_length(),
-                                'min_participants': quiz.get_min_participants()
-                                })
-        data['highest_id'] = new_id
-    with open(json_path, 'w', encoding='utf-8') as f:
-        print('stored Quiz ID: ' + str(new_id) + ' to data')
-        json.dump(data, f)
-
-
-def get_player_id(nickname, json_path='players.json'):
+    scores = sorted(([player_id, score] for player_id, score in scoreboard.items()), key=lambda entry: -entry[1])
+    new_id = (storage or get_storage()).insert('results', {'id': None,
+                                                           'quiz_id': quiz_id,
+                                                           'finished': int(time.time()),
+                                                           'scores': scores})
+    logger.info('stored result %d of quiz %s', new_id, quiz_id)
+    return new_id
+
+
+def get_player_id(nickname, storage=None):
     '''
     get the id of a player by nickname
     :param nickname: nickname to search for
-    :param json_path: path to json file
+    :param storage: storage backend, defaults to the configured one
     :return: id if player is present, else None
     '''
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        for player in data['players']:
-            if player['nickname'] == nickname:
-                return player['id']
-        return None
+    player = (storage or get_storage()).find_record('players', 'nickname', nickname)
+    return player['id'] if player is not None else None
 
 
-def get_question_id(questioning, json_path='questions.json'):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        for question in data['questions']:
-            if question['questioning'] == questioning:
-                return question['id']
-        return None
+def get_question_id(questioning, storage=None):
+    question = (storage or get_storage()).find_record('questions', 'questioning', questioning)
+    return question['id'] if question is not None else None
 
 
-def get_quiz_id(title, json_path='quizzes.json'):
-    with open(json_path, encoding='utf-8') as f:
-        data = json.load(f)
-        for quiz in data['quizzes']:
-            if quiz['title'] == title:
-                return quiz['id']
-        return None
+def get_quiz_id(title, storage=None):
+    quiz = (storage or get_storage()).find_record('quizzes', 'title', title)
+    return quiz['id'] if quiz is not None else None
+
+
+def run_io(function, *args):
+    """
+    runs a blocking function on the io thread pool, must be called on the event loop
+    :return: awaitable future of the result
+    """
+    return asyncio.get_running_loop().run_in_executor(io_executor, functools.partial(function, *args))
+
+
+async def get_player_async(id, storage=None):
+    return await run_io(get_player, id, storage)
+
+
+async def get_quiz_async(id, storage=None):
+    return await run_io(get_quiz, id, storage)
+
+
+async def get_player_id_async(nickname, storage=None):
+    return await run_io(get_player_id, nickname, storage)
+
+
+async def store_player_async(player, storage=None):
+    return await run_io(store_player, player, storage)
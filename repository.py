@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+import atexit
+import codec
+import os
+import threading
+import time
+import CONSTANTS
+from journal import Journal, apply_records
+
+
+class Repository:
+    """
+    in-memory copy of one json data file (players.json, questions.json or quizzes.json)
+    the file is parsed once and kept in hash indexes, so lookups do not touch the disk.
+    changes on disk are detected by comparing mtime and size of the file.
+    new records are appended to the journal of the file instead of rewriting it (see journal.py)
+    """
+    def __init__(self, json_path, collection, unique_fields, grouped_fields=()):
+        """
+        :param json_path: path to the json file
+        :param collection: key of the record list in the file, e.g. 'players'
+        :param unique_fields: fields that identify a record, e.g. ('id', 'nickname')
+        :param grouped_fields: fields that are shared by many records, e.g. ('topic',)
+        """
+        self.json_path = json_path
+        self.collection = collection
+        self.unique_fields = unique_fields
+        self.grouped_fields = grouped_fields
+        self.journal = Journal(json_path, collection, self._compacted)
+        self.lock = self.journal.lock
+        self.records = []
+        self.highest_id = 0
+        self.version = 0
+        self._indexes = {}
+        self._groups = {}
+        self._positions = {}  # id -> index in records
+        self._signature = None
+        self._last_check = 0
+
+    def get_version(self):
+        """
+        increments every time the data changes, can be used to invalidate derived caches
+        """
+        self.refresh()
+        return self.version
+
+    def get_highest_id(self):
+        self.refresh()
+        return self.highest_id
+
+    def find(self, field, value):
+        """
+        get the record whose unique field equals value
+        :return: record dict or None
+        """
+        self.refresh()
+        if field == 'id':
+            value = int(value)
+        return self._indexes[field].get(value)
+
+    def find_all(self, field, value):
+        """
+        get all records of a grouped field, e.g. all questions of a topic
+        :return: new list of record dicts, empty list if there are none
+        """
+        self.refresh()
+        return list(self._groups[field].get(value, ()))
+
+    def all(self):
+        self.refresh()
+        return self.records
+
+    def insert(self, record):
+        """
+        adds a new record, its id is allocated in memory
+        :param record: record dict, its 'id' field is overwritten
+        :return: the new id
+        """
+        with self.lock:
+            self.refresh()
+            self.highest_id += 1
+            record['id'] = self.highest_id
+            position = self.journal.write(record)
+            self._apply([record])
+            self.version += 1
+            self.journal.wait(position)  # releases the lock, so concurrent writers share the fsync
+            return record['id']
+
+    def put(self, record):
+        """
+        replaces the record with the same id
+        :param record: complete record dict
+        """
+        with self.lock:
+            self.refresh()
+            position = self.journal.write(record)
+            self._apply([record])
+            self.version += 1
+            self.journal.wait(position)
+
+    def put_many(self, records):
+        """
+        replaces many records, they are journaled as one batch that is replayed completely or not at all
+        """
+        with self.lock:
+            self.refresh()
+            position = self.journal.write({'batch': records})
+            self._apply(records)
+            self.version += 1
+            self.journal.wait(position)
+
+    def refresh(self):
+        """
+        reloads the file if it changed on disk. the file is stat'ed at most once per REPOSITORY_CHECK_INTERVAL
+        """
+        now = time.monotonic()
+        if self._signature is not None and now - self._last_check < CONSTANTS.REPOSITORY_CHECK_INTERVAL:
+            return
+        with self.lock:
+            self._last_check = now
+            signature = self._stat()
+            if signature != self._signature:
+                self.load()
+
+    def invalidate(self):
+        """
+        forces a reload on the next access
+        """
+        with self.lock:
+            self._signature = None
+
+    def load(self):
+        with self.lock:
+            signature = self._stat()
+            with open(self.json_path, 'rb') as f:
+                data = codec.load(f)
+            apply_records(data, self.collection, self.journal.replay())
+            self._build(data)
+            self._signature = signature
+
+    def _compacted(self, before, after):
+        """
+        the journal folded itself into the json file, which is what is in memory already, so the new file is not
+        parsed again. a file that was changed by someone else in the meantime is still reloaded
+        """
+        if self._signature == before:
+            self._signature = after
+
+    def _build(self, data):
+        """
+        the records and indexes are built aside and swapped in at the end, lookups without the lock
+        (e.g. on the io threads) see either the old or the new data, never a half built index
+        """
+        records = []
+        positions = {}
+        indexes = {field: {} for field in self.unique_fields}
+        groups = {field: {} for field in self.grouped_fields}
+        for record in data[self.collection]:
+            positions[record['id']] = len(records)
+            records.append(record)
+            self._add_to_indexes(record, indexes, groups)
+        self.highest_id = max([int(data['highest_id'])] + [record['id'] for record in records])
+        self.records, self._positions, self._indexes, self._groups = records, positions, indexes, groups
+        self.version += 1
+
+    def _apply(self, changed):
+        """
+        replaces the records with the same ids or adds them. like _build, the changes are made to copies that are
+        swapped in at the end, the lists of the live indexes are never changed while a lookup may walk them
+        :param changed: record dicts
+        """
+        records = list(self.records)
+        positions = dict(self._positions)
+        indexes = {field: dict(index) for field, index in self._indexes.items()}
+        groups = {field: dict(group) for field, group in self._groups.items()}
+        copied = set()  # (field, value) of the group lists that were copied already
+        for record in changed:
+            old = indexes['id'].get(record['id'])
+            if old is None:
+                positions[record['id']] = len(records)
+                records.append(record)
+            else:
+                records[positions[record['id']]] = record
+                self._remove_from_indexes(old, indexes, groups, copied)
+            self._add_to_indexes(record, indexes, groups, copied)
+        self.records, self._positions, self._indexes, self._groups = records, positions, indexes, groups
+
+    def _add_to_indexes(self, record, indexes, groups, copied=None):
+        """
+        :param copied: see _remove_from_indexes, None while the indexes are built
+        """
+        for field in self.unique_fields:
+            indexes[field].setdefault(record[field], record)  # first match wins, like the former linear scan
+        for field in self.grouped_fields:
+            self._get_group(groups, field, record[field], copied).append(record)
+
+    def _remove_from_indexes(self, record, indexes, groups, copied):
+        """
+        :param copied: (field, value) of the group lists that belong to the copied groups already, the others are
+                       shared with the live groups and copied before they are changed
+        """
+        for field in self.unique_fields:
+            if indexes[field].get(record[field]) is record:
+                del indexes[field][record[field]]
+        for field in self.grouped_fields:
+            self._get_group(groups, field, record[field], copied).remove(record)
+
+    @staticmethod
+    def _get_group(groups, field, value, copied):
+        group = groups[field].get(value)
+        if group is None:
+            group = groups[field][value] = []
+        elif copied is not None and (field, value) not in copied:
+            group = groups[field][value] = list(group)
+        if copied is not None:
+            copied.add((field, value))
+        return group
+
+    def _stat(self):
+        stat = os.stat(self.json_path)
+        return stat.st_mtime_ns, stat.st_size
+
+
+class RepositoryPool:
+    repositories = {}
+    _lock = threading.Lock()
+
+    # collection key and indexed fields of every known data file
+    layouts = {'players': (('id', 'nickname'), ()),
+               'questions': (('id', 'questioning'), ('topic',)),
+               'quizzes': (('id', 'title'), ())}
+
+    @staticmethod
+    def get(json_path, collection):
+        """
+        get the shared repository of a json file, it is created and loaded on first access
+        :param json_path: path to the json file
+        :param collection: 'players', 'questions' or 'quizzes'
+        """
+        key = os.path.abspath(json_path)
+        repository = RepositoryPool.repositories.get(key)
+        if repository is None:
+            with RepositoryPool._lock:
+                repository = RepositoryPool.repositories.get(key)
+                if repository is None:
+                    unique_fields, grouped_fields = RepositoryPool.layouts[collection]
+                    repository = Repository(json_path, collection, unique_fields, grouped_fields)
+                    RepositoryPool.repositories[key] = repository
+                    atexit.register(repository.journal.close)
+        return repository
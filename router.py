@@ -0,0 +1,130 @@
+# -*- coding: utf-8 -*-
+"""
+dispatch of incoming websocket messages by their 'type'.
+every message type has a schema, which is compiled once into a flat list of (key, converter, default) and a
+namedtuple class. a message is validated and converted before its handler runs, malformed messages are rejected
+without touching any game state
+"""
+import codec
+from collections import namedtuple
+from log import get_traffic_logger
+
+logger = get_traffic_logger('router')
+
+REQUIRED = object()
+
+Context = namedtuple('Context', ['connection', 'player_id', 'player', 'game'])
+
+
+class Schema:
+    """
+    converts a message dict into a namedtuple of its fields, a schema can be the converter of a nested field
+    """
+    def __init__(self, name, fields):
+        """
+        :param name: name of the namedtuple class
+        :param fields: {key: converter or (converter, default)}, fields without a default are required.
+                       a converter is a callable that returns the converted value or raises ValueError or TypeError
+        """
+        self.type = namedtuple(name, list(fields))
+        self.fields = tuple((key, spec[0], spec[1]) if isinstance(spec, tuple) else (key, spec, REQUIRED)
+                            for key, spec in fields.items())
+
+    def __call__(self, value):
+        if not isinstance(value, dict):
+            raise TypeError('object expected')
+        values = []
+        for key, converter, default in self.fields:
+            if key in value:
+                values.append(converter(value[key]))
+            elif default is REQUIRED:
+                raise ValueError('missing key ' + key)
+            else:
+                values.append(default)
+        return self.type._make(values)
+
+
+class MessageRouter:
+    """
+    handlers are registered per message type with route() and called as handler(context, message)
+    """
+    def __init__(self, get_game, forward=None):
+        """
+        :param get_game: get_game(game_id, player_id) returns the game of a game id the player plays in or None,
+                         used for messages with a 'game_id' field
+        :param forward: forward(connection, game_id, message dict) hands the message of a game that is not hosted
+                        here to the node that hosts it and returns True, or returns False if there is none
+        """
+        self.get_game = get_game
+        self.forward = forward
+        self.routes = {}  # {type: (schema, handler, has_game)}
+
+    def route(self, message_type, **fields):
+        """
+        decorator that registers the handler of a message type
+        :param fields: schema of the message, see Schema
+        """
+        def register(handler):
+            self.routes[message_type] = (Schema(message_type, fields), handler, 'game_id' in fields)
+            return handler
+        return register
+
+    def dispatch(self, connection, raw):
+        """
+        :param connection: websocket connection the message came from, its pid and player are the sending player
+        :param raw: json text of the message
+        :return: the result of the handler, e.g. a coroutine, None if the message was rejected
+        """
+        try:
+            msg = codec.loads(raw)
+        except (ValueError, TypeError) as e:
+            logger.warning('rejected message of player %s: %s', connection.pid, e)
+            return None
+        return self.dispatch_message(connection, msg)
+
+    def dispatch_message(self, connection, msg):
+        """
+        like dispatch() for a decoded message, e.g. one that another node forwarded
+        """
+        try:
+            schema, handler, has_game = self.routes[msg['type']]
+            message = schema(msg)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning('rejected message of player %s: %s', connection.pid, e)
+            return None
+        game = None
+        if has_game:
+            game = self.get_game(message.game_id, connection.pid)
+            if game is None:
+                if self.forward is not None and self.forward(connection, message.game_id, msg):
+                    return None
+                logger.warning('rejected message of player %s for unknown game %s', connection.pid, message.game_id)
+                return None
+        return handler(Context(connection, connection.pid, connection.player, game), message)
+
+
+def boolean(value):
+    if not isinstance(value, bool):
+        raise TypeError('boolean expected')
+    return value
+
+
+def number(value):
+    if isinstance(value, bool) or not isinstance(value, (int, float)):
+        raise TypeError('number expected')
+    return value
+
+
+def integer(value):
+    """
+    ints and strings of ints, e.g. the quiz id of a select box
+    """
+    if isinstance(value, bool):
+        raise TypeError('integer expected')
+    return int(value)
+
+
+def string(value):
+    if not isinstance(value, str):
+        raise TypeError('string expected')
+    return value
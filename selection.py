@@ -0,0 +1,133 @@
+# -*- coding: utf-8 -*-
+import random
+from array import array
+from collections import OrderedDict, deque
+import CONSTANTS
+from storage import get_storage
+
+
+class QuestionSelector:
+    """
+    weighted random choice of the questions of a game.
+    for every topic the question ids and an alias table of their weights are precomputed,
+    so drawing k distinct questions costs O(k) no matter how many questions the topic has.
+    questions a player got within their last QUESTION_REPEAT_WINDOW questions are avoided, this is remembered for the
+    QUESTION_REPEAT_PLAYERS players that played last
+    """
+    def __init__(self, seed=None, storage=None):
+        """
+        :param seed: seed of the random generator, for reproducible selections
+        :param storage: storage backend, defaults to the configured one
+        """
+        self.random = random.Random(seed)
+        self.storage = storage
+        self.tables = {}  # {topic: (ids, probabilities, aliases, set of the ids)}
+        self.version = None
+        self.recent = OrderedDict()  # {player_id: deque of the last question ids the player got}, least recent first
+
+    def select(self, topic, k, player_ids=()):
+        """
+        draws k distinct questions of a topic, questions with a higher weight are drawn more often
+        :param topic: topic of the questions
+        :param k: amount of questions, at most the amount of questions of the topic
+        :param player_ids: players of the game, their recently played questions are avoided
+        :return: list of question ids
+        """
+        ids, probabilities, aliases, id_set = self.get_table(topic)
+        k = min(k, len(ids))
+        excluded = set()
+        for player_id in player_ids:
+            excluded.update(self.recent.get(player_id, ()))
+        excluded &= id_set  # recent questions of other topics do not narrow this one
+        if len(ids) - len(excluded) < k:  # window covers too much of the topic, allow repeats
+            excluded = set()
+        chosen = []
+        chosen_set = set()
+        attempts = CONSTANTS.QUESTION_SELECTION_ATTEMPTS * k + len(excluded)
+        n = len(ids)
+        while len(chosen) < k and attempts > 0:
+            attempts -= 1
+            index = int(self.random.random() * n)
+            if self.random.random() >= probabilities[index]:
+                index = aliases[index]
+            question_id = ids[index]
+            if question_id not in chosen_set and question_id not in excluded:
+                chosen.append(question_id)
+                chosen_set.add(question_id)
+        if len(chosen) < k:
+            # very unlikely, happens if a few heavy questions dominate the topic
+            rest = [question_id for question_id in ids if question_id not in chosen_set and question_id not in excluded]
+            self.random.shuffle(rest)
+            chosen.extend(rest[:k - len(chosen)])
+        for player_id in player_ids:
+            if player_id in self.recent:
+                self.recent.move_to_end(player_id)
+            else:
+                self.recent[player_id] = deque(maxlen=CONSTANTS.QUESTION_REPEAT_WINDOW)
+            self.recent[player_id].extend(chosen)
+        while len(self.recent) > CONSTANTS.QUESTION_REPEAT_PLAYERS:
+            self.recent.popitem(last=False)
+        return chosen
+
+    def get_table(self, topic):
+        """
+        the alias table of a topic, rebuilt when the stored questions changed
+        """
+        storage = self.storage or get_storage()
+        version = storage.get_version('questions')
+        if version != self.version:
+            self.tables = {}
+            self.version = version
+        if topic not in self.tables:
+            self.load_topic(topic, storage.find_records('questions', 'topic', topic))
+        return self.tables[topic]
+
+    def load_topic(self, topic, records):
+        """
+        precomputes ids and alias table of a topic
+        :param records: question records of the topic
+        """
+        ids = array('q', [record['id'] for record in records])
+        probabilities, aliases = build_alias_table([question_weight(record) for record in records])
+        self.tables[topic] = (ids, probabilities, aliases, frozenset(ids))
+
+
+def question_weight(record):
+    """
+    harder questions (by static and by measured, dynamic difficulty) are drawn more often
+    """
+    return max(record['staticDifficulty'] or 0, CONSTANTS.MIN_QUESTION_WEIGHT) * \
+        max(record['dynamicDifficulty'] or 0, CONSTANTS.MIN_QUESTION_WEIGHT)
+
+
+def build_alias_table(weights):
+    """
+    alias table of Vose's alias method, draws an index with probability weights[i] / sum(weights) in O(1)
+    :return: (probabilities, aliases)
+    """
+    n = len(weights)
+    probabilities = array('d', [0.0] * n)
+    aliases = array('l', [0] * n)
+    if n == 0:
+        return probabilities, aliases
+    total = float(sum(weights))
+    scaled = [weight * n / total for weight in weights]
+    small = [i for i, p in enumerate(scaled) if p < 1]
+    large = [i for i, p in enumerate(scaled) if p >= 1]
+    while small and large:
+        less = small.pop()
+        more = large.pop()
+        probabilities[less] = scaled[less]
+        aliases[less] = more
+        scaled[more] = scaled[more] + scaled[less] - 1
+        if scaled[more] < 1:
+            small.append(more)
+        else:
+            large.append(more)
+    for i in small + large:
+        probabilities[i] = 1.0
+        aliases[i] = i
+    return probabilities, aliases
+
+
+selector = QuestionSelector()
@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""
+sessions of logged in players. a session token is '<player id>.<expiry>.<signature>', signed with SESSION_SECRET,
+so a worker or node that did not issue a token can still verify it (it loads the player once and caches it)
+"""
+import hashlib
+import hmac
+import os
+import time
+from collections import OrderedDict
+import CONSTANTS
+from model import get_player_async
+
+# generated at import when no secret is configured, the workers of one server share it because they are forked later
+SECRET = (CONSTANTS.SESSION_SECRET or os.urandom(32).hex()).encode('utf-8')
+
+
+class SessionStore:
+    """
+    players by session token, oldest sessions are evicted when there are more than SESSION_CAPACITY
+    """
+    sessions = OrderedDict()  # {token: (player, expiry)}, oldest first
+
+    @staticmethod
+    def create(player):
+        """
+        :param player: the logged in player
+        :return: session token
+        """
+        expiry = int(time.time()) + CONSTANTS.SESSION_TTL
+        payload = str(player.get_id()) + '.' + str(expiry)
+        token = payload + '.' + _sign(payload)
+        SessionStore._put(token, player, expiry)
+        return token
+
+    @staticmethod
+    async def resolve(token):
+        """
+        :return: the player of a session, None if the token is invalid or expired
+        """
+        entry = SessionStore.sessions.get(token)
+        if entry is not None:
+            player, expiry = entry
+            if expiry > time.time():
+                return player
+            del SessionStore.sessions[token]
+            return None
+        player_id, expiry = _verify(token)
+        if player_id is None:
+            return None
+        player = await get_player_async(player_id)  # token of another worker
+        if player is not None:
+            SessionStore._put(token, player, expiry)
+        return player
+
+    @staticmethod
+    def remove(token):
+        SessionStore.sessions.pop(token, None)
+
+    @staticmethod
+    def _put(token, player, expiry):
+        SessionStore.sessions[token] = (player, expiry)
+        while len(SessionStore.sessions) > CONSTANTS.SESSION_CAPACITY:
+            SessionStore.sessions.popitem(last=False)
+
+
+def _sign(payload):
+    return hmac.new(SECRET, payload.encode('utf-8'), hashlib.sha256).hexdigest()
+
+
+def _verify(token):
+    """
+    :return: (player id, expiry) of a correctly signed token that did not expire, (None, None) otherwise
+    """
+    try:
+        player_id, expiry, signature = token.split('.')
+        player_id, expiry = int(player_id), int(expiry)
+    except ValueError:
+        return None, None
+    if not hmac.compare_digest(signature, _sign(str(player_id) + '.' + str(expiry))) or expiry <= time.time():
+        return None, None
+    return player_id, expiry
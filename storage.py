@@ -0,0 +1,389 @@
+# -*- coding: utf-8 -*-
+"""
+storage backends behind the model functions. records are dicts shaped like the entries of the json files,
+e.g. {'id': 1, 'nickname': 'test1', 'password': '123', 'mail': 'test@mail.de'}
+
+migrate the json files into a sqlite database:
+$ python3 storage.py migrate [--db quizgame.db]
+"""
+import argparse
+import codec
+import sqlite3
+import threading
+import time
+import CONSTANTS
+from jsonl_store import JsonLinesLog, JsonLinesQuestionStore
+from repository import RepositoryPool
+
+
+class StorageBackend:
+    """
+    interface of a storage backend, collections are 'players', 'questions', 'quizzes' and 'results'
+    """
+    def get_record(self, collection, id):
+        """
+        :return: record with the given id or None
+        """
+        raise NotImplementedError
+
+    def find_record(self, collection, field, value):
+        """
+        :return: first record (lowest id) whose field equals value or None
+        """
+        raise NotImplementedError
+
+    def find_records(self, collection, field, value):
+        """
+        :return: list of all records whose field equals value
+        """
+        raise NotImplementedError
+
+    def all_records(self, collection):
+        raise NotImplementedError
+
+    def insert(self, collection, record):
+        """
+        adds a new record and allocates its id
+        :return: the new id
+        """
+        raise NotImplementedError
+
+    def put(self, collection, record):
+        """
+        adds or replaces the record with the id of record
+        """
+        raise NotImplementedError
+
+    def put_many(self, collection, records):
+        for record in records:
+            self.put(collection, record)
+
+    def get_version(self, collection):
+        """
+        changes whenever the collection changes, used to invalidate caches
+        """
+        raise NotImplementedError
+
+
+class JsonBackend(StorageBackend):
+    """
+    the json files with their journals, served from in-memory repositories (see repository.py).
+    results are only appended and never read while playing, they go to a json lines log (see jsonl_store.py)
+    """
+    logged = ('results',)  # collections kept in an append-only log instead of a repository
+
+    def __init__(self, paths=None):
+        """
+        :param paths: file of every collection, defaults to players.json, questions.json, quizzes.json and results.jsonl
+        """
+        self.paths = paths or {'players': 'players.json', 'questions': 'questions.json', 'quizzes': 'quizzes.json',
+                               'results': 'results.jsonl'}
+        self.logs = {collection: JsonLinesLog(self.paths[collection]) for collection in self.logged}
+
+    def get_repository(self, collection):
+        return self.logs.get(collection) or RepositoryPool.get(self.paths[collection], collection)
+
+    def get_record(self, collection, id):
+        return self.get_repository(collection).find('id', id)
+
+    def find_record(self, collection, field, value):
+        return self.get_repository(collection).find(field, value)
+
+    def find_records(self, collection, field, value):
+        return self.get_repository(collection).find_all(field, value)
+
+    def all_records(self, collection):
+        return self.get_repository(collection).all()
+
+    def insert(self, collection, record):
+        return self.get_repository(collection).insert(record)
+
+    def put(self, collection, record):
+        self.get_repository(collection).put(record)
+
+    def put_many(self, collection, records):
+        self.get_repository(collection).put_many(records)
+
+    def get_version(self, collection):
+        return self.get_repository(collection).get_version()
+
+
+class JsonLinesBackend(JsonBackend):
+    """
+    like JsonBackend, but questions are read from a json lines file through its offset index (see jsonl_store.py)
+    """
+    def __init__(self, paths=None, questions_path=None):
+        JsonBackend.__init__(self, paths)
+        self.questions = JsonLinesQuestionStore(questions_path or CONSTANTS.QUESTIONS_JSONL_PATH)
+
+    def get_record(self, collection, id):
+        if collection == 'questions':
+            return self.questions.get(id)
+        return JsonBackend.get_record(self, collection, id)
+
+    def find_record(self, collection, field, value):
+        if collection == 'questions':
+            if field == 'id':
+                return self.questions.get(value)
+            elif field == 'questioning':
+                return self.questions.find_by_questioning(value)
+            return next((record for record in self.questions.all() if record[field] == value), None)
+        return JsonBackend.find_record(self, collection, field, value)
+
+    def find_records(self, collection, field, value):
+        if collection == 'questions':
+            if field == 'topic':
+                return self.questions.find_by_topic(value)
+            return [record for record in self.questions.all() if record[field] == value]
+        return JsonBackend.find_records(self, collection, field, value)
+
+    def all_records(self, collection):
+        if collection == 'questions':
+            return self.questions.all()
+        return JsonBackend.all_records(self, collection)
+
+    def insert(self, collection, record):
+        if collection == 'questions':
+            return self.questions.insert(record)
+        return JsonBackend.insert(self, collection, record)
+
+    def put(self, collection, record):
+        if collection == 'questions':
+            self.questions.put(record)
+        else:
+            JsonBackend.put(self, collection, record)
+
+    def put_many(self, collection, records):
+        if collection == 'questions':
+            self.questions.put_many(records)
+        else:
+            JsonBackend.put_many(self, collection, records)
+
+    def get_version(self, collection):
+        if collection == 'questions':
+            self.questions.refresh()
+            return self.questions.version
+        return JsonBackend.get_version(self, collection)
+
+
+class SqliteBackend(StorageBackend):
+    """
+    sqlite database in WAL mode. every thread reuses its own connection,
+    statements are built once and kept in sqlite3's statement cache
+    """
+    # {collection: [(record field, column), ...]}, id always comes first
+    columns = {'players': [('id', 'id'), ('nickname', 'nickname'), ('password', 'password'), ('mail', 'mail')],
+               'questions': [('id', 'id'), ('questioning', 'questioning'), ('topic', 'topic'), ('answers', 'answers'),
+                             ('dynamicDifficulty', 'dynamic_difficulty'), ('staticDifficulty', 'static_difficulty'),
+                             ('responseTime', 'response_time'), ('worth', 'worth')],
+               'quizzes': [('id', 'id'), ('title', 'title'), ('length', 'length'), ('min_participants', 'min_participants')],
+               'results': [('id', 'id'), ('quiz_id', 'quiz_id'), ('finished', 'finished'), ('scores', 'scores')]}
+    encoded_fields = ('answers', 'scores')  # stored as json text
+
+    schema = '''
+        CREATE TABLE IF NOT EXISTS players (id INTEGER PRIMARY KEY, nickname TEXT, password TEXT, mail TEXT);
+        CREATE INDEX IF NOT EXISTS players_nickname ON players (nickname);
+        CREATE TABLE IF NOT EXISTS questions (id INTEGER PRIMARY KEY, questioning TEXT, topic TEXT, answers TEXT,
+                                              dynamic_difficulty NUMERIC, static_difficulty NUMERIC,
+                                              response_time INTEGER, worth INTEGER);
+        CREATE INDEX IF NOT EXISTS questions_questioning ON questions (questioning);
+        CREATE INDEX IF NOT EXISTS questions_topic ON questions (topic);
+        CREATE TABLE IF NOT EXISTS quizzes (id INTEGER PRIMARY KEY, title TEXT, length INTEGER, min_participants INTEGER);
+        CREATE INDEX IF NOT EXISTS quizzes_title ON quizzes (title);
+        CREATE TABLE IF NOT EXISTS results (id INTEGER PRIMARY KEY, quiz_id INTEGER, finished INTEGER, scores TEXT);
+        CREATE INDEX IF NOT EXISTS results_quiz_id ON results (quiz_id);
+        CREATE TABLE IF NOT EXISTS versions (collection TEXT PRIMARY KEY, version INTEGER);
+    '''
+    # the version of a table is counted up by triggers, so every process sees which tables the others changed
+    version_triggers = '''
+        INSERT OR IGNORE INTO versions VALUES ('{0}', 0);
+        CREATE TRIGGER IF NOT EXISTS {0}_inserted AFTER INSERT ON {0}
+            BEGIN UPDATE versions SET version = version + 1 WHERE collection = '{0}'; END;
+        CREATE TRIGGER IF NOT EXISTS {0}_updated AFTER UPDATE ON {0}
+            BEGIN UPDATE versions SET version = version + 1 WHERE collection = '{0}'; END;
+        CREATE TRIGGER IF NOT EXISTS {0}_deleted AFTER DELETE ON {0}
+            BEGIN UPDATE versions SET version = version + 1 WHERE collection = '{0}'; END;
+    '''
+
+    def __init__(self, db_path=None):
+        self.db_path = db_path or CONSTANTS.SQLITE_PATH
+        self._local = threading.local()
+        self._lock = threading.Lock()
+        self._versions = {collection: 0 for collection in self.columns}  # local versions, see get_version()
+        self._stored_versions = {}  # {collection: last seen version of the versions table}
+        self._data_version = None
+        self._last_check = 0
+        self._statements = {collection: self._build_statements(collection) for collection in self.columns}
+        self._watch = self._connect()
+        self._watch.executescript(self.schema + ''.join(self.version_triggers.format(collection)
+                                                        for collection in self.columns))
+        self._stored_versions = self._read_stored_versions(self._watch)
+
+    def get_record(self, collection, id):
+        return self._fetch_one(self._statements[collection]['find_one']['id'], (int(id),), collection)
+
+    def find_record(self, collection, field, value):
+        return self._fetch_one(self._statements[collection]['find_one'][field], (value,), collection)
+
+    def find_records(self, collection, field, value):
+        rows = self._get_connection().execute(self._statements[collection]['find_all'][field], (value,)).fetchall()
+        return [self._to_record(collection, row) for row in rows]
+
+    def all_records(self, collection):
+        rows = self._get_connection().execute(self._statements[collection]['select'] + ' ORDER BY id').fetchall()
+        return [self._to_record(collection, row) for row in rows]
+
+    def insert(self, collection, record):
+        connection = self._get_connection()
+        with connection:
+            cursor = connection.execute(self._statements[collection]['insert'], self._to_row(collection, record)[1:])
+            stored_version = self._read_stored_version(connection, collection)
+        record['id'] = cursor.lastrowid
+        self._changed(collection, stored_version)
+        return record['id']
+
+    def put(self, collection, record):
+        self.put_many(collection, [record])
+
+    def put_many(self, collection, records):
+        """
+        adds or replaces many records in one transaction
+        """
+        connection = self._get_connection()
+        with connection:
+            connection.executemany(self._statements[collection]['replace'],
+                                   [self._to_row(collection, record) for record in records])
+            stored_version = self._read_stored_version(connection, collection)
+        self._changed(collection, stored_version)
+
+    def get_version(self, collection):
+        self._check_external_changes()
+        return self._versions[collection]
+
+    def _build_statements(self, collection):
+        fields = [field for field, column in self.columns[collection]]
+        columns = [column for field, column in self.columns[collection]]
+        select = 'SELECT ' + ', '.join(columns) + ' FROM ' + collection
+        return {'select': select,
+                'find_one': {field: select + ' WHERE ' + column + ' = ? ORDER BY id LIMIT 1'
+                             for field, column in self.columns[collection]},
+                'find_all': {field: select + ' WHERE ' + column + ' = ? ORDER BY id'
+                             for field, column in self.columns[collection]},
+                'insert': 'INSERT INTO ' + collection + ' (' + ', '.join(columns[1:]) + ') VALUES (' +
+                          ', '.join('?' * (len(fields) - 1)) + ')',
+                'replace': 'INSERT OR REPLACE INTO ' + collection + ' (' + ', '.join(columns) + ') VALUES (' +
+                           ', '.join('?' * len(fields)) + ')'}
+
+    def _connect(self):
+        connection = sqlite3.connect(self.db_path, cached_statements=256, check_same_thread=False)
+        connection.execute('PRAGMA journal_mode=WAL')
+        connection.execute('PRAGMA synchronous=NORMAL')
+        return connection
+
+    def _get_connection(self):
+        connection = getattr(self._local, 'connection', None)
+        if connection is None:
+            connection = self._local.connection = self._connect()
+        return connection
+
+    def _fetch_one(self, statement, parameters, collection):
+        row = self._get_connection().execute(statement, parameters).fetchone()
+        return self._to_record(collection, row) if row is not None else None
+
+    def _to_record(self, collection, row):
+        record = {}
+        for (field, column), value in zip(self.columns[collection], row):
+            record[field] = codec.loads(value) if field in self.encoded_fields else value
+        return record
+
+    def _to_row(self, collection, record):
+        return tuple(codec.dumps_text(record[field]) if field in self.encoded_fields else record[field]
+                     for field, column in self.columns[collection])
+
+    def _changed(self, collection, stored_version):
+        """
+        a write of this process, read within its transaction the stored version is this write's own
+        """
+        with self._lock:
+            self._versions[collection] += 1
+            self._stored_versions[collection] = max(self._stored_versions.get(collection, 0), stored_version)
+
+    @staticmethod
+    def _read_stored_version(connection, collection):
+        return connection.execute('SELECT version FROM versions WHERE collection = ?', (collection,)).fetchone()[0]
+
+    @staticmethod
+    def _read_stored_versions(connection):
+        return dict(connection.execute('SELECT collection, version FROM versions').fetchall())
+
+    def _check_external_changes(self):
+        """
+        bumps the versions of the tables another process changed, checked at most once per REPOSITORY_CHECK_INTERVAL.
+        data_version only tells that any other connection committed, the versions table tells which tables changed
+        """
+        now = time.monotonic()
+        if now - self._last_check < CONSTANTS.REPOSITORY_CHECK_INTERVAL:
+            return
+        with self._lock:
+            self._last_check = now
+            data_version = self._watch.execute('PRAGMA data_version').fetchone()[0]
+            if data_version != self._data_version:
+                self._data_version = data_version
+                for collection, stored_version in self._read_stored_versions(self._watch).items():
+                    if stored_version > self._stored_versions.get(collection, 0):
+                        self._stored_versions[collection] = stored_version
+                        self._versions[collection] += 1
+
+
+_storage = None
+_storage_lock = threading.Lock()
+
+
+def get_storage():
+    """
+    get the storage backend configured in CONSTANTS.STORAGE_BACKEND, created on first access
+    """
+    global _storage
+    if _storage is None:
+        with _storage_lock:
+            if _storage is None:
+                _storage = create_storage(CONSTANTS.STORAGE_BACKEND)
+    return _storage
+
+
+def set_storage(storage):
+    global _storage
+    _storage = storage
+
+
+def create_storage(name):
+    """
+    :param name: 'json', 'jsonl' or 'sqlite'
+    """
+    if name == 'json':
+        return JsonBackend()
+    elif name == 'jsonl':
+        return JsonLinesBackend()
+    elif name == 'sqlite':
+        return SqliteBackend()
+    raise ValueError('unknown storage backend: ' + str(name))
+
+
+def migrate(source, target):
+    """
+    copies every record of every collection from source to target, keeping the ids
+    """
+    for collection in SqliteBackend.columns:
+        records = source.all_records(collection)
+        target.put_many(collection, records)
+        print('migrated ' + str(len(records)) + ' ' + collection)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='storage maintenance')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    migrate_parser = subparsers.add_parser('migrate', help='import the json data files into sqlite')
+    migrate_parser.add_argument('--db', default=CONSTANTS.SQLITE_PATH, help='sqlite database file')
+    args = parser.parse_args()
+    if args.command == 'migrate':
+        migrate(JsonBackend(), SqliteBackend(args.db))
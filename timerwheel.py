@@ -0,0 +1,129 @@
+# -*- coding: utf-8 -*-
+"""
+hierarchical timing wheel for the many timers of running games, e.g. question deadlines.
+a single PeriodicCallback advances the wheel by TIMER_TICK seconds, scheduling and cancelling a timer is O(1).
+level 0 has one slot per tick, a slot of level n covers the whole wheel of level n - 1. timers of a higher level
+are moved down (cascaded) when the lower level wraps around, so every timer is touched at most once per level
+"""
+import math
+import time
+import tornado.ioloop
+import CONSTANTS
+from log import get_logger
+
+logger = get_logger('timerwheel')
+
+
+class Timer:
+    __slots__ = ('deadline', 'callback', 'args', 'slot')
+
+    def __init__(self, deadline, callback, args):
+        self.deadline = deadline  # tick at which the timer expires
+        self.callback = callback
+        self.args = args
+        self.slot = None  # set of the wheel slot the timer is in, None once it expired or was cancelled
+
+    def cancel(self):
+        if self.slot is not None:
+            self.slot.discard(self)
+            self.slot = None
+
+    def is_active(self):
+        return self.slot is not None
+
+
+class TimerWheel:
+    def __init__(self, tick=None, bits=None, levels=None, clock=time.monotonic):
+        """
+        :param tick: seconds per tick, defaults to TIMER_TICK
+        :param bits: every level has 2 ** bits slots, defaults to TIMER_WHEEL_BITS
+        :param levels: defaults to TIMER_WHEEL_LEVELS, timers further away than 2 ** (bits * levels) ticks are
+                       cascaded from the last slot until they are in range
+        :param clock: time source in seconds
+        """
+        self.tick = tick or CONSTANTS.TIMER_TICK
+        self.bits = bits or CONSTANTS.TIMER_WHEEL_BITS
+        self.mask = (1 << self.bits) - 1
+        self.levels = [[set() for _ in range(1 << self.bits)] for _ in range(levels or CONSTANTS.TIMER_WHEEL_LEVELS)]
+        self.clock = clock
+        self.origin = clock()
+        self.current = 0  # last tick that was processed
+        self.callback = None
+
+    def start(self):
+        """
+        advances the wheel on the current IOLoop
+        """
+        if self.callback is None:
+            self.callback = tornado.ioloop.PeriodicCallback(self.advance, self.tick * 1000)
+            self.callback.start()
+
+    def stop(self):
+        if self.callback is not None:
+            self.callback.stop()
+            self.callback = None
+
+    def schedule(self, delay, callback, *args):
+        """
+        :param delay: seconds, rounded up to whole ticks
+        :return: Timer, call its cancel() if it is not needed anymore
+        """
+        ticks = max(1, math.ceil((self.clock() - self.origin + delay) / self.tick) - self.current)
+        timer = Timer(self.current + ticks, callback, args)
+        self._place(timer)
+        return timer
+
+    def advance(self, now=None):
+        """
+        runs the callbacks of all timers that expired until now
+        :param now: time of the clock, defaults to the current time
+        :return: amount of expired timers
+        """
+        now = self.clock() if now is None else now
+        target = int((now - self.origin) / self.tick)
+        expired = 0
+        while self.current < target:
+            self.current += 1
+            self._cascade(1)
+            slot = self.levels[0][self.current & self.mask]
+            while slot:
+                timer = slot.pop()
+                if timer.deadline > self.current:  # beyond the range of the wheel when it was placed
+                    self._place(timer)
+                    continue
+                timer.slot = None
+                expired += 1
+                try:
+                    timer.callback(*timer.args)
+                except Exception:
+                    logger.exception('timer callback failed')
+        return expired
+
+    def __len__(self):
+        return sum(len(slot) for level in self.levels for slot in level)
+
+    def _place(self, timer):
+        distance = timer.deadline - self.current
+        for level_index, level in enumerate(self.levels):
+            if distance < 1 << (self.bits * (level_index + 1)):
+                break
+        deadline = min(timer.deadline, self.current + (1 << (self.bits * len(self.levels))) - 1)
+        timer.slot = level[(deadline >> (self.bits * level_index)) & self.mask]
+        timer.slot.add(timer)
+
+    def _cascade(self, level_index):
+        """
+        moves the timers of the next slot of a level to the levels below, when the level below wrapped around
+        """
+        if level_index == len(self.levels) or (self.current >> (self.bits * (level_index - 1))) & self.mask:
+            return
+        index = (self.current >> (self.bits * level_index)) & self.mask
+        self._cascade(level_index + 1)
+        slot = self.levels[level_index][index]
+        timers = list(slot)
+        slot.clear()
+        for timer in timers:
+            self._place(timer)
+
+
+timers = TimerWheel()
@@ -0,0 +1,140 @@
+# -*- coding: utf-8 -*-
+"""
+encodings of server to client messages. clients pick one through the websocket subprotocol:
+- quiz.json: json text frames (default)
+- quiz.msgpack: MessagePack binary frames, known keys are replaced by the short tags in TAGS
+"""
+import codec
+import struct
+
+JSON = 'quiz.json'
+MSGPACK = 'quiz.msgpack'
+SUBPROTOCOLS = (MSGPACK, JSON)  # preferred first
+
+# key -> short tag, sent to msgpack clients in a 'wire_tags' message right after the connection opened
+TAGS = {'type': 't',
+        'game_id': 'g',
+        'question': 'q',
+        'jackpot': 'j',
+        'amount': 'am',
+        'is_active': 'ia',
+        'scoreboard': 's',
+        'scoreboard_delta': 'sd',
+        'seq': 'sq',
+        'base': 'b',
+        'scores': 'sc',
+        'answers': 'a',
+        'id': 'i',
+        'content': 'c',
+        'assigned_effects': 'e',
+        'dynamicDifficulty': 'dd',
+        'staticDifficulty': 'sdf',
+        'questioning': 'qs',
+        'responseTime': 'rt',
+        'topic': 'tp',
+        'worth': 'w',
+        'lobby': 'l',
+        'nicks': 'n',
+        'item': 'it',
+        'message': 'm',
+        'p_id': 'p'}
+
+
+def encode(message, encoding):
+    """
+    :param message: message dict
+    :param encoding: JSON or MSGPACK
+    :return: (payload bytes, websocket opcode)
+    """
+    if encoding == MSGPACK:
+        return packb(compact(message)), 0x2
+    return codec.dumps(message), 0x1
+
+
+def compact(obj):
+    """
+    replaces known dict keys by their tags, recursively
+    """
+    if isinstance(obj, dict):
+        return {TAGS.get(key, key) if isinstance(key, str) else key: compact(value) for key, value in obj.items()}
+    if isinstance(obj, (list, tuple)):
+        return [compact(value) for value in obj]
+    return obj
+
+
+def packb(obj):
+    """
+    MessagePack encoding of None, bool, int, float, str, bytes, list, tuple and dict
+    """
+    out = bytearray()
+    _pack(obj, out)
+    return bytes(out)
+
+
+def _pack(obj, out):
+    if obj is None:
+        out.append(0xc0)
+    elif obj is True:
+        out.append(0xc3)
+    elif obj is False:
+        out.append(0xc2)
+    elif isinstance(obj, int):
+        _pack_int(obj, out)
+    elif isinstance(obj, float):
+        out += struct.pack('>Bd', 0xcb, obj)
+    elif isinstance(obj, str):
+        data = obj.encode('utf-8')
+        _pack_length(len(data), out, 0xa0, 32, (0xd9, 0xda, 0xdb))
+        out += data
+    elif isinstance(obj, (bytes, bytearray)):
+        _pack_length(len(obj), out, None, 0, (0xc4, 0xc5, 0xc6))
+        out += obj
+    elif isinstance(obj, (list, tuple)):
+        _pack_length(len(obj), out, 0x90, 16, (None, 0xdc, 0xdd))
+        for value in obj:
+            _pack(value, out)
+    elif isinstance(obj, dict):
+        _pack_length(len(obj), out, 0x80, 16, (None, 0xde, 0xdf))
+        for key, value in obj.items():
+            _pack(key, out)
+            _pack(value, out)
+    else:
+        raise TypeError('cannot pack ' + type(obj).__name__)
+
+
+def _pack_int(value, out):
+    if 0 <= value < 0x80:
+        out.append(value)
+    elif -0x20 <= value < 0:
+        out.append(value & 0xff)
+    elif 0 <= value <= 0xff:
+        out += struct.pack('>BB', 0xcc, value)
+    elif 0 <= value <= 0xffff:
+        out += struct.pack('>BH', 0xcd, value)
+    elif 0 <= value <= 0xffffffff:
+        out += struct.pack('>BI', 0xce, value)
+    elif value > 0:
+        out += struct.pack('>BQ', 0xcf, value)
+    elif value >= -0x80:
+        out += struct.pack('>Bb', 0xd0, value)
+    elif value >= -0x8000:
+        out += struct.pack('>Bh', 0xd1, value)
+    elif value >= -0x80000000:
+        out += struct.pack('>Bi', 0xd2, value)
+    else:
+        out += struct.pack('>Bq', 0xd3, value)
+
+
+def _pack_length(length, out, fix_type, fix_limit, types):
+    """
+    writes the type byte and length of a str, bin, array or map
+    :param types: type bytes for 8, 16 and 32 bit lengths, None where the format has no such variant
+    """
+    if fix_type is not None and length < fix_limit:
+        out.append(fix_type | length)
+    elif types[0] is not None and length <= 0xff:
+        out += struct.pack('>BB', types[0], length)
+    elif length <= 0xffff:
+        out += struct.pack('>BH', types[1], length)
+    else:
+        out += struct.pack('>BI', types[2], length)
@@ -0,0 +1,60 @@
+# -*- coding: utf-8 -*-
+"""
+multi-process mode. the server forks into worker processes that share the main port for http requests,
+every worker also listens on a port of its own for websockets. lobbies and games live in the worker
+whose websocket port their players connected to, GET /route tells a client which one that is.
+
+lobbies of a quiz rotate over the workers: every worker gets min_participants of the clients that are routed to
+the quiz in a row, then the next worker gets the next ones. the counters of routed clients are kept in shared memory,
+so every worker routes the same way
+"""
+import multiprocessing
+import tornado.netutil
+import tornado.process
+import CONSTANTS
+
+
+class WorkerPool:
+    count = 1
+    index = 0
+    routed = None  # shared array of clients routed per quiz slot, None in single-process mode
+
+    @staticmethod
+    def start(count, port):
+        """
+        binds the main port and forks the workers, returns in every worker (the parent restarts crashed workers)
+        :param count: amount of workers, 0 for one per cpu core
+        :param port: main port
+        :return: sockets of the main port
+        """
+        sockets = tornado.netutil.bind_sockets(port)
+        count = count or tornado.process.cpu_count()
+        if count > 1:
+            WorkerPool.routed = multiprocessing.Array('l', CONSTANTS.LOBBY_SLOTS)
+            WorkerPool.index = tornado.process.fork_processes(count)
+        WorkerPool.count = count
+        return sockets
+
+    @staticmethod
+    def get_port(worker):
+        """
+        websocket port of a worker
+        """
+        if WorkerPool.count == 1:
+            return CONSTANTS.PORT
+        return CONSTANTS.WORKER_BASE_PORT + worker
+
+    @staticmethod
+    def route(quiz_id, min_participants):
+        """
+        assigns a client to the worker that hosts the next lobby of a quiz
+        :param min_participants: players of a lobby of the quiz, that many clients are routed to the same worker
+        :return: worker index
+        """
+        if WorkerPool.routed is None:
+            return 0
+        slot = quiz_id % CONSTANTS.LOBBY_SLOTS
+        with WorkerPool.routed.get_lock():
+            routed = WorkerPool.routed[slot]
+            WorkerPool.routed[slot] = routed + 1
+        return (quiz_id + routed // max(min_participants, 1)) % WorkerPool.count